@@ -1,10 +1,18 @@
+import os
+import gc
+import json
+import time
+import queue
 import torch
 import GPT
 import GPTC
 import GPTA
+import threading
 import torch.nn as nn
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import Future
 from flask_cors import CORS 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 
 
 # Initialize Flask app
@@ -19,9 +27,40 @@ GPT_CONFIG_124M = {
     "n_heads": 12,          # Number of attention heads
     "n_layers": 12,         # Number of layers
     "drop_rate": 0.1,       # Dropout rate
-    "qkv_bias": True       # Query-key-value bias
+    "qkv_bias": True,       # Query-key-value bias
+    "attn_backend": "sdpa", # Fused scaled dot product attention
+    "fused_qkv": True,      # Single query-key-value projection
+    "fused_ops": True       # Fused LayerNorm and GELU kernels
 }
 
+# Models loaded at startup (comma separated, e.g. "classification"), the rest are loaded on first use
+WARMUP_MODELS = [name for name in os.environ.get("GPT_WARMUP_MODELS", "").split(",") if name]
+# Seconds without requests before a model is unloaded (disabled if not set)
+MODEL_IDLE_TIMEOUT = float(os.environ["GPT_MODEL_IDLE_TIMEOUT"]) if "GPT_MODEL_IDLE_TIMEOUT" in os.environ else None
+# Checkpoint of the base GPT-2 model, if set both tasks are served as adapters of this single model (see Models/extract_adapter.py)
+SHARED_BASE_MODEL = os.environ.get("GPT_BASE_MODEL")
+# Dynamic int8 quantization of the linear layers (CPU only). Not applied to the shared base model,
+# its adapters switch the float biases and layer norms of the base layers. The checkpoints converted by
+# Models/quantize_model.py (classifier-int8.pth, Assistant-int8.pth) are loaded when they exist.
+QUANTIZE_MODELS = os.environ.get("GPT_QUANTIZE", "0") == "1"
+# torch.compile of the models (not combined with the quantization), the compiled graphs are cached on disk
+COMPILE_MODELS = os.environ.get("GPT_COMPILE", "0") == "1"
+COMPILE_CACHE_DIR = os.environ.get("GPT_COMPILE_CACHE", "../Models/compile-cache")
+# Inference backend of the task models (not of the shared base model): "torch" or "onnx" (ONNX Runtime
+# on the CPU, graphs exported with Models/export_onnx.py)
+INFERENCE_BACKEND = os.environ.get("GPT_BACKEND", "torch")
+ONNX_NUM_THREADS = int(os.environ["GPT_ONNX_THREADS"]) if "GPT_ONNX_THREADS" in os.environ else None
+# Checkpoint of a small draft model (GPT_DRAFT_LAYERS layers, same tokenizer, see Models/train_ddp.py --n-layers)
+# for the speculative decoding of /AssistantStream, it proposes GPT_DRAFT_TOKENS tokens per forward pass of the
+# assistant (torch backend)
+DRAFT_MODEL = os.environ.get("GPT_DRAFT_MODEL")
+DRAFT_CONFIG = {**GPT_CONFIG_124M, "n_layers": int(os.environ.get("GPT_DRAFT_LAYERS", "4"))}
+NUM_DRAFT_TOKENS = int(os.environ.get("GPT_DRAFT_TOKENS", "4"))
+SPECULATIVE_DECODING = DRAFT_MODEL is not None and INFERENCE_BACKEND == "torch"
+# Memory budget (MB) of the keys/values of the recent assistant prompts, their common prefixes
+# (the instruction preamble of GPTA.format_input) are not processed again. 0 disables it.
+PREFIX_CACHE_MB = float(os.environ.get("GPT_PREFIX_CACHE_MB", "256"))
+
 
 # Tokenizer
 tokenizer = GPT.create_tokenizer()
@@ -29,19 +68,244 @@ tokenizer = GPT.create_tokenizer()
 # Device
 device = GPT.get_device()
 
-# Assistant model 
-classification_model = GPT.GPTModel(GPT_CONFIG_124M)
-classification_model.out_head = torch.nn.Linear(in_features=GPT_CONFIG_124M["emb_dim"], out_features=2)
-classification_model.load_state_dict(torch.load("../Models/classifier.pth", map_location=device, weights_only=True))
-classification_model.to(device)
-classification_model.eval()
 
 
-# Classifier model 
-assistant_model = GPT.GPTModel(GPT_CONFIG_124M)
-assistant_model.load_state_dict(torch.load("../Models/Assistant.pth"))
-assistant_model.to(device)
 
+"""
+  ModelRegistry
+    Loads every registered model on its first use (or on warm_up), keeps track of the load
+    times and unloads the models that have been idle for longer than idle_timeout seconds.
+    A model is never unloaded while it is in use (between the start and the end of use()).
+    Adapters are served by the model they were registered on, with the adapter activated.
+"""
+class ModelRegistry:
+	def __init__(self, idle_timeout=None):
+		self.idle_timeout = idle_timeout
+		self.loaders = {}
+		self.locks = {}
+		self.models = {}
+		self.load_times = {}
+		self.last_used = {}
+		self.in_use = {}
+		self.adapters = {}
+
+	def register(self, name, loader):
+		self.loaders[name] = loader
+		self.locks[name] = threading.Lock()
+
+	def register_adapter(self, name, base_name):
+		self.adapters[name] = base_name
+
+	def get(self, name):
+		with self.locks[name]:
+			if name not in self.models:
+				start_time = time.perf_counter()
+				self.models[name] = self.loaders[name]()
+				self.load_times[name] = time.perf_counter() - start_time
+				print(f"Model '{name}' loaded in {self.load_times[name]:.2f} seconds")
+			self.last_used[name] = time.monotonic()
+			return self.models[name]
+
+	# Model serving the given task, the adapters of a shared model take turns on every forward pass
+	@contextmanager
+	def use(self, name):
+		model_name = self.adapters.get(name, name)
+		with self.locks[model_name]:
+			self.in_use[model_name] = self.in_use.get(model_name, 0) + 1
+		try:
+			model = self.get(model_name)
+			yield GPT.AdapterModel(model, name) if name in self.adapters else model
+		finally:
+			# Idle from the end of the use (e.g. of a long generation), not from its start
+			with self.locks[model_name]:
+				self.in_use[model_name] -= 1
+				self.last_used[model_name] = time.monotonic()
+
+	def warm_up(self, names):
+		for name in names:
+			self.get(self.adapters.get(name, name))
+
+	# Unloads a model that is not in use (and, with idle_timeout, idle for longer than it)
+	def unload(self, name, idle_timeout=None):
+		with self.locks[name]:
+			if self.in_use.get(name, 0) > 0:
+				return
+			if idle_timeout is not None and time.monotonic() - self.last_used.get(name, time.monotonic()) <= idle_timeout:
+				return
+			if self.models.pop(name, None) is not None:
+				gc.collect()
+				if device.type == "cuda":
+					torch.cuda.empty_cache()
+				print(f"Model '{name}' unloaded")
+
+	def unload_idle(self):
+		for name in list(self.models):
+			self.unload(name, self.idle_timeout)
+
+	# Periodically unload the idle models
+	def idle_worker(self):
+		while True:
+			time.sleep(self.idle_timeout / 2)
+			self.unload_idle()
+
+	def stats(self):
+		now = time.monotonic()
+		return {
+			name: {
+				"loaded": name in self.models,
+				"load_time": self.load_times.get(name),
+				"in_use": self.in_use.get(name, 0),
+				"idle_time": now - self.last_used[name] if name in self.last_used else None
+			}
+			for name in self.loaders
+		}
+
+
+
+
+# Token length buckets of the batch classification. The classifier was fine-tuned reading the last
+# token after padding to 120, shorter buckets shift its predictions. A classifier fine-tuned reading
+# the last real token (Models/train_ddp.py --dynamic-padding) is served with GPT_CLASSIFIER_LAST_TOKEN=1,
+# with real buckets (torch backend, the ONNX graphs only return the last position).
+CLASSIFICATION_LAST_REAL_TOKEN = os.environ.get("GPT_CLASSIFIER_LAST_TOKEN", "0") == "1" and INFERENCE_BACKEND == "torch"
+CLASSIFICATION_BUCKETS = (32, 64, 120) if CLASSIFICATION_LAST_REAL_TOKEN else (120,)
+CLASSIFICATION_MAX_BATCH = 32
+
+
+"""
+  compile_served_model
+    Compiles a loaded model and runs it once on the served shapes (classification buckets, or a short
+    generation), so the graphs are compiled (or loaded from the cache) at load time and not on the
+    first request. The lengths of the classification buckets are static, the batch size is dynamic
+    (one graph for single texts and one for the batches of 2 to CLASSIFICATION_MAX_BATCH texts).
+"""
+def compile_served_model(model, generation=False):
+	model = GPT.compile_model(model, COMPILE_CACHE_DIR, dynamic=True if generation else None)
+	with torch.no_grad():
+		if generation:
+			GPT.batch_text_generation(model, [[0] * 8], 2, GPT_CONFIG_124M["context_length"], device)
+		else:
+			for size in CLASSIFICATION_BUCKETS:
+				for batch_size in (1, 2):
+					input_ids = torch.zeros((batch_size, size), dtype=torch.long, device=device)
+					positions = torch.full((batch_size,), size - 1, device=device) if CLASSIFICATION_LAST_REAL_TOKEN else -1
+					if batch_size > 1:
+						torch._dynamo.mark_dynamic(input_ids, 0, max=CLASSIFICATION_MAX_BATCH)
+						if CLASSIFICATION_LAST_REAL_TOKEN:
+							torch._dynamo.mark_dynamic(positions, 0, max=CLASSIFICATION_MAX_BATCH)
+					model(input_ids, positions=positions)
+	return model
+
+
+# Dynamic int8 model: the checkpoint converted by Models/quantize_model.py if there is one, otherwise quantized on load
+def load_int8_model(checkpoint_path, quantized_path, out_features=None):
+	if os.path.exists(quantized_path):
+		return GPT.load_quantized_model(GPT_CONFIG_124M, quantized_path, out_features=out_features)
+	return GPT.quantize_model(GPT.load_model(GPT_CONFIG_124M, checkpoint_path, device, out_features=out_features))
+
+
+# Classification model (memory-mapped weights, shared by the workers through the page cache)
+def load_classification_model():
+	if INFERENCE_BACKEND == "onnx":
+		return GPT.OnnxModel("../Models/classifier.onnx", GPT_CONFIG_124M["context_length"], ONNX_NUM_THREADS)
+	if QUANTIZE_MODELS and device.type == "cpu":
+		return load_int8_model("../Models/classifier.pth", "../Models/classifier-int8.pth", out_features=2)
+	model = GPT.load_model(GPT_CONFIG_124M, "../Models/classifier.pth", device, out_features=2)
+	if COMPILE_MODELS:
+		model = compile_served_model(model)
+	return model
+
+
+# Assistant model
+def load_assistant_model():
+	if INFERENCE_BACKEND == "onnx":
+		return GPT.OnnxModel("../Models/Assistant.onnx", GPT_CONFIG_124M["context_length"], ONNX_NUM_THREADS)
+	if QUANTIZE_MODELS and device.type == "cpu":
+		return load_int8_model("../Models/Assistant.pth", "../Models/Assistant-int8.pth")
+	model = GPT.load_model(GPT_CONFIG_124M, "../Models/Assistant.pth", device)
+	if COMPILE_MODELS:
+		model = compile_served_model(model, generation=True)
+	return model
+
+
+# Base model shared by the adapters of both tasks
+def load_shared_model():
+	model = GPT.add_lora_layers(GPT.load_model(GPT_CONFIG_124M, SHARED_BASE_MODEL, device))
+	GPT.load_adapter(model, "classification", torch.load("../Models/classifier-adapter.pth", map_location="cpu", weights_only=True))
+	GPT.load_adapter(model, "assistant", torch.load("../Models/Assistant-adapter.pth", map_location="cpu", weights_only=True))
+	if COMPILE_MODELS:
+		# The graphs of every adapter are compiled on their first use
+		model = GPT.compile_model(model, COMPILE_CACHE_DIR, dynamic=True)
+	return model
+
+
+# Draft model of the speculative decoding
+def load_draft_model():
+	return GPT.load_model(DRAFT_CONFIG, DRAFT_MODEL, device)
+
+
+models = ModelRegistry(idle_timeout=MODEL_IDLE_TIMEOUT)
+if SHARED_BASE_MODEL is not None:
+	models.register("base", load_shared_model)
+	models.register_adapter("classification", "base")
+	models.register_adapter("assistant", "base")
+else:
+	models.register("classification", load_classification_model)
+	models.register("assistant", load_assistant_model)
+if SPECULATIVE_DECODING:
+	models.register("draft", load_draft_model)
+models.warm_up(WARMUP_MODELS)
+if MODEL_IDLE_TIMEOUT is not None:
+	threading.Thread(target=models.idle_worker, daemon=True).start()
+
+
+# Keys/values of the assistant prompts (only valid for the assistant model)
+assistant_prefix_cache = GPT.PrefixCache(int(PREFIX_CACHE_MB * 2**20)) if PREFIX_CACHE_MB > 0 else None
+
+
+# Micro-batching of the assistant requests
+ASSISTANT_MAX_BATCH = 8         # Maximum number of prompts decoded together
+ASSISTANT_BATCH_WAIT = 0.005    # Seconds to wait for concurrent requests
+assistant_queue = queue.Queue()
+
+
+"""
+  assistant_worker
+    Takes the queued prompts, gathers the ones arriving in the next few milliseconds
+    and decodes them as a single batch, answering every request through its future.
+"""
+def assistant_worker():
+	while True:
+		batch = [assistant_queue.get()]
+		deadline = time.monotonic() + ASSISTANT_BATCH_WAIT
+		while len(batch) < ASSISTANT_MAX_BATCH:
+			timeout = deadline - time.monotonic()
+			if timeout <= 0:
+				break
+			try:
+				batch.append(assistant_queue.get(timeout=timeout))
+			except queue.Empty:
+				break
+
+		try:
+			with models.use("assistant") as model:
+				generated = GPT.batch_text_generation(
+					model=model,
+					prompts=[token_ids for token_ids, _ in batch],
+					num_token_generation=256,
+					context_size=GPT_CONFIG_124M["context_length"],
+					device=device,
+					eos_id=50256,
+					prefix_cache=assistant_prefix_cache
+				)
+			for (_, future), token_ids in zip(batch, generated):
+				future.set_result(token_ids)
+		except Exception as e:
+			for _, future in batch:
+				future.set_exception(e)
+
+
+threading.Thread(target=assistant_worker, daemon=True).start()
 
 
 
@@ -51,6 +315,13 @@ def home():
 
 
 
+# Loaded models and their load times
+@app.route("/models")
+def models_status():
+    return jsonify(models.stats())
+
+
+
 
 
 # Endpoint for Classification model
@@ -62,8 +333,37 @@ def classify():
 			return jsonify({"error": "Missing 'input' key in JSON payload"}), 400
 		
 		input_text = (data["input"])
-		with torch.no_grad():
-			output_model = GPTC.classify_review(input_text, classification_model, tokenizer, device, max_length=120)
+		with torch.no_grad(), models.use("classification") as model:
+			output_model = GPTC.classify_review(input_text, model, tokenizer, device, max_length=120, last_real_token=CLASSIFICATION_LAST_REAL_TOKEN)
+
+		return jsonify({"response": output_model})
+	except Exception as e:
+		return jsonify({"error": str(e)}), 500
+
+
+
+
+
+
+# Endpoint for the batch classification, the texts are grouped by length into buckets
+@app.route("/ClassificationBatch", methods=["POST"])
+def classify_batch():
+	try:
+		data = request.json
+		if "inputs" not in data or not isinstance(data["inputs"], list):
+			return jsonify({"error": "Missing 'inputs' list in JSON payload"}), 400
+
+		with models.use("classification") as model:
+			labels, probabilities = GPTC.classify_batch(
+				data["inputs"], model, tokenizer, device,
+				bucket_sizes=CLASSIFICATION_BUCKETS,
+				batch_size=CLASSIFICATION_MAX_BATCH,
+				last_real_token=CLASSIFICATION_LAST_REAL_TOKEN
+			)
+		output_model = [
+			{"label": label, "probabilities": {"not spam": probas[0], "spam": probas[1]}}
+			for label, probas in zip(labels, probabilities)
+		]
 
 		return jsonify({"response": output_model})
 	except Exception as e:
@@ -87,22 +387,18 @@ def predict():
 			"input": data["input"]
 		} 
 
-		with torch.no_grad():
-			input_text = GPTA.format_input(entry)
-			token_ids = GPT.text_generation(
-				model=assistant_model,
-				idx=GPT.text_to_token_ids(input_text, tokenizer).to(device),
-				num_token_generation=256,
-				context_size=GPT_CONFIG_124M["context_length"],
-				eos_id=50256
-			)
-			generated_text = GPT.token_ids_to_text(token_ids, tokenizer)
-			response_text = (
-				generated_text[len(input_text):]
-				.replace("### Response:", "")
-				.strip()
-			)
-			output_model = response_text.strip()
+		# Queue the prompt and wait for the batching worker to decode it
+		input_text = GPTA.format_input(entry)
+		future = Future()
+		assistant_queue.put((tokenizer.encode(input_text, allowed_special={"<|endoftext|>"}), future))
+		token_ids = future.result()
+
+		response_text = (
+			tokenizer.decode(token_ids)
+			.replace("### Response:", "")
+			.strip()
+		)
+		output_model = response_text.strip()
 
 		return jsonify({"response": output_model})
 	except Exception as e:
@@ -111,6 +407,97 @@ def predict():
 
 
 
+"""
+  stream_response
+    Text of the streamed tokens without the "### Response:" header the model writes before the answer.
+    The start of the stream is held back while it could still be part of that header.
+"""
+def stream_response(token_stream):
+	header = "### Response:"
+	decoder = GPT.StreamDecoder(tokenizer)
+	pending, started = "", False
+	for idx_next in token_stream:
+		text = decoder.decode(idx_next.item())
+		if started:
+			if text:
+				yield text
+			continue
+		pending += text
+		stripped = pending.lstrip()
+		if stripped.startswith(header):
+			stripped = stripped[len(header):].lstrip()
+		elif header.startswith(stripped):
+			continue
+		if stripped:
+			started = True
+			yield stripped
+
+	# End of the stream, release the held back text
+	if started:
+		text = decoder.flush()
+	else:
+		text = (pending + decoder.flush()).strip()
+		if text.startswith(header):
+			text = text[len(header):].strip()
+		elif header.startswith(text):
+			text = ""
+	if text:
+		yield text
+
+
+
+
+# Streaming endpoint for Assistant model (server-sent events, one event per piece of text)
+@app.route("/AssistantStream", methods=["POST"])
+def predict_stream():
+	try:
+		data = request.json
+		if "instruction" not in data:
+			return jsonify({"error": "Missing 'instruction' key in JSON payload"}), 400
+
+		entry = { 
+			"instruction": data["instruction"],
+			"input": data["input"]
+		} 
+		input_text = GPTA.format_input(entry)
+	except Exception as e:
+		return jsonify({"error": str(e)}), 500
+
+	def events():
+		try:
+			with models.use("assistant") as model, (models.use("draft") if SPECULATIVE_DECODING else nullcontext()) as draft_model:
+				idx = GPT.text_to_token_ids(input_text, tokenizer).to(device)
+				if draft_model is not None:
+					token_stream = GPT.stream_speculative_generation(
+						model=model,
+						draft_model=draft_model,
+						idx=idx,
+						num_token_generation=256,
+						context_size=GPT_CONFIG_124M["context_length"],
+						num_draft_tokens=NUM_DRAFT_TOKENS,
+						eos_id=50256
+					)
+				else:
+					token_stream = GPT.stream_text_generation(
+						model=model,
+						idx=idx,
+						num_token_generation=256,
+						context_size=GPT_CONFIG_124M["context_length"],
+						eos_id=50256,
+						use_cache=True,
+						prefix_cache=assistant_prefix_cache
+					)
+				for text in stream_response(token_stream):
+					yield f"data: {json.dumps({'response': text})}\n\n"
+			yield f"data: {json.dumps({'done': True})}\n\n"
+		except Exception as e:
+			yield f"data: {json.dumps({'error': str(e)})}\n\n"
+
+	return Response(stream_with_context(events()), mimetype="text/event-stream")
+
+
+
+
 # Run the Flask app
 if __name__ == "__main__":
 	app.run(host="0.0.0.0", port=4000)
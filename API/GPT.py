@@ -1,26 +1,154 @@
 import os
+import re
+import codecs
+import random
+import hashlib
 import torch
+import threading
 import tiktoken
 import numpy as np
 import urllib.request
 import torch.nn as nn
+import torch.distributed as dist
 import matplotlib.pyplot as plt
 from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset
+from torch.utils.data import get_worker_info
 from torch.utils.data import DataLoader
+from torch.utils.checkpoint import checkpoint
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 from matplotlib.ticker import MaxNLocator
 
 
+class KVCache:
+	"""
+	  Keys and values of the already processed tokens for every transformer block, 
+	  so the next generation steps only need to process the new tokens.
+	  Shape of each entry: (b, num_heads, num_tokens, head_dim)
+	"""
+	def __init__(self, n_layers):
+		self.keys = [None] * n_layers
+		self.values = [None] * n_layers
+
+	# Number of tokens already stored for a layer
+	def num_tokens(self, layer_idx=0):
+		if self.keys[layer_idx] is None:
+			return 0
+		return self.keys[layer_idx].shape[2]
+
+	def __len__(self):
+		return self.num_tokens(0)
+
+	# Append the new keys and values, returns the keys and values of all the tokens
+	def update(self, layer_idx, keys, values):
+		if self.keys[layer_idx] is not None:
+			keys = torch.cat((self.keys[layer_idx], keys), dim=2)
+			values = torch.cat((self.values[layer_idx], values), dim=2)
+		self.keys[layer_idx] = keys
+		self.values[layer_idx] = values
+		return keys, values
+
+	def reset(self):
+		self.keys = [None] * len(self.keys)
+		self.values = [None] * len(self.values)
+
+	# Keep only the first num_tokens tokens (e.g. drop the rejected tokens of speculative decoding)
+	def truncate(self, num_tokens):
+		self.keys = [None if keys is None else keys[:, :, :num_tokens] for keys in self.keys]
+		self.values = [None if values is None else values[:, :, :num_tokens] for values in self.values]
+
+
+
+
+# Number of leading tokens shared by all the sequences
+def common_prefix_length(*sequences):
+	length = 0
+	for tokens in zip(*sequences):
+		if any(token != tokens[0] for token in tokens):
+			break
+		length += 1
+	return length
+
+
+
+
+class PrefixCache:
+	"""
+	  Keys and values of already processed prompts (LRU, at most max_bytes), so a new prompt only processes
+	  the tokens after its longest cached prefix (e.g. the fixed instruction preamble). The keys/values of a 
+	  token only depend on the tokens before it, any prefix of a stored prompt can be reused. The stored 
+	  tensors are never modified (KVCache.update concatenates), the caches returned by lookup share them.
+	"""
+	def __init__(self, max_bytes=256 * 2**20):
+		self.max_bytes = max_bytes
+		self.entries = OrderedDict()		# token ids -> (keys, values, bytes)
+		self.num_bytes = 0
+		self.lock = threading.Lock()
+
+	# Cache with the keys/values of the longest cached prefix of token_ids (at most max_tokens), None if there is none
+	def lookup(self, token_ids, max_tokens=None, batch_size=1):
+		max_tokens = len(token_ids) if max_tokens is None else min(max_tokens, len(token_ids))
+		with self.lock:
+			best_tokens, num_tokens = None, 0
+			for tokens in self.entries:
+				length = min(common_prefix_length(tokens, token_ids), max_tokens)
+				if length > num_tokens:
+					best_tokens, num_tokens = tokens, length
+			if best_tokens is None:
+				return None
+			self.entries.move_to_end(best_tokens)
+			keys, values, _ = self.entries[best_tokens]
+
+		kv_cache = KVCache(len(keys))
+		kv_cache.keys = [layer_keys[:, :, :num_tokens].repeat(batch_size, 1, 1, 1) for layer_keys in keys]
+		kv_cache.values = [layer_values[:, :, :num_tokens].repeat(batch_size, 1, 1, 1) for layer_values in values]
+		return kv_cache
+
+	# Stores the keys/values of the first len(token_ids) tokens of a row of kv_cache
+	def store(self, token_ids, kv_cache, row=0):
+		tokens = tuple(token_ids)
+		keys = [layer_keys[row:row + 1, :, :len(tokens)].clone() for layer_keys in kv_cache.keys]
+		values = [layer_values[row:row + 1, :, :len(tokens)].clone() for layer_values in kv_cache.values]
+		num_bytes = sum(tensor.numel() * tensor.element_size() for tensor in keys + values)
+		if num_bytes > self.max_bytes:
+			return
+		with self.lock:
+			for cached_tokens in list(self.entries):
+				length = common_prefix_length(cached_tokens, tokens)
+				if length == len(tokens):
+					# Already covered by a longer (or the same) prompt
+					self.entries.move_to_end(cached_tokens)
+					return
+				if length == len(cached_tokens):
+					# The new prompt covers this one
+					self.num_bytes -= self.entries.pop(cached_tokens)[2]
+			self.entries[tokens] = (keys, values, num_bytes)
+			self.num_bytes += num_bytes
+			while self.num_bytes > self.max_bytes:
+				self.num_bytes -= self.entries.popitem(last=False)[1][2]
+
+
+
+
 class MultiHeadAttention(nn.Module):
-	def __init__(self, d_in, d_out, context_length, dropout, num_heads, qkv_bias=False):
+	def __init__(self, d_in, d_out, context_length, dropout, num_heads, qkv_bias=False, attn_backend="manual", fused_qkv=False):
 		super().__init__() 
 		assert (d_out % num_heads == 0),  "Out dimension must be divisible by the number of heads"
+		assert (attn_backend in ("manual", "sdpa")), "Attention backend must be 'manual' or 'sdpa'"
 
 		self.d_out = d_out
 		self.num_heads = num_heads
 		self.head_dim = d_out // num_heads
-		self.W_query = nn.Linear(d_in, d_out, bias=qkv_bias)
-		self.W_key = nn.Linear(d_in, d_out, bias=qkv_bias)
-		self.W_value = nn.Linear(d_in, d_out, bias=qkv_bias)
+		self.attn_backend = attn_backend
+		self.fused_qkv = fused_qkv
+		if fused_qkv:
+			# Queries, keys and values with a single matmul (same layout as GPT-2 c_attn)
+			self.W_qkv = nn.Linear(d_in, 3 * d_out, bias=qkv_bias)
+		else:
+			self.W_query = nn.Linear(d_in, d_out, bias=qkv_bias)
+			self.W_key = nn.Linear(d_in, d_out, bias=qkv_bias)
+			self.W_value = nn.Linear(d_in, d_out, bias=qkv_bias)
 		self.out_proj = nn.Linear(d_out, d_out)
 		self.dropout = nn.Dropout(dropout)
 		self.register_buffer(
@@ -29,12 +157,33 @@ class MultiHeadAttention(nn.Module):
 		)
 
 
-	def forward(self, x):
+	# Checkpoints can store the query/key/value projections either split or fused, convert to the layout of this module
+	def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+		split_names = ("W_query", "W_key", "W_value")
+		for param in ("weight", "bias"):
+			split_keys = [f"{prefix}{name}.{param}" for name in split_names]
+			fused_key = f"{prefix}W_qkv.{param}"
+			if self.fused_qkv and all(key in state_dict for key in split_keys):
+				state_dict[fused_key] = torch.cat([state_dict.pop(key) for key in split_keys], dim=0)
+			elif not self.fused_qkv and fused_key in state_dict:
+				for key, tensor in zip(split_keys, state_dict.pop(fused_key).chunk(3, dim=0)):
+					state_dict[key] = tensor
+		super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+	"""
+	  attn_mask: optional boolean mask broadcastable to (b, num_heads, num_tokens, num_keys), 
+	  True where the attention is allowed (e.g. to hide the padding), combined with the causal mask.
+	"""
+	def forward(self, x, kv_cache=None, layer_idx=0, attn_mask=None):
 		b, num_tokens, _ = x.shape 	# Shape: (b, num_tokens, d_out)
 
-		keys = self.W_key(x)
-		queries = self.W_query(x)
-		values = self.W_value(x)
+		if self.fused_qkv:
+			queries, keys, values = self.W_qkv(x).split(self.d_out, dim=-1)
+		else:
+			keys = self.W_key(x)
+			queries = self.W_query(x)
+			values = self.W_value(x)
 
 		# Split the matrix on the heads 
 		keys = keys.view(b, num_tokens, self.num_heads, self.head_dim)
@@ -46,19 +195,58 @@ class MultiHeadAttention(nn.Module):
 		queries = queries.transpose(1, 2)
 		values = values.transpose(1, 2)
 
-		# Attention scores 
-		attn_scores = queries @ keys.transpose(2, 3)
-
-		# Mask 
-		mask_bool = self.mask.bool()[:num_tokens, :num_tokens]
-		attn_scores.masked_fill_(mask_bool, -torch.inf)
-
-		# Attention weights
-		attn_weights = torch.softmax(attn_scores / keys.shape[-1]**0.5, dim=-1)
-		attn_weights = self.dropout(attn_weights)
+		# Incremental decoding: attend to the cached tokens of the previous steps as well
+		num_past = 0
+		if kv_cache is not None:
+			num_past = kv_cache.num_tokens(layer_idx)
+			keys, values = kv_cache.update(layer_idx, keys, values)
+		num_keys = keys.shape[2]
+
+		if self.attn_backend == "sdpa":
+			# Fused kernel: scores, mask, scaling, softmax and dropout without the (num_tokens x num_keys) intermediates
+			dropout_p = self.dropout.p if self.training else 0.0
+			if attn_mask is not None:
+				# Additive mask with a finite minimum, so the rows of padded queries do not turn into NaN
+				allowed = ~self.mask[num_past:num_past + num_tokens, :num_keys].bool() & attn_mask
+				float_mask = torch.zeros(allowed.shape, dtype=queries.dtype, device=queries.device)
+				float_mask.masked_fill_(~allowed, torch.finfo(queries.dtype).min)
+				context = nn.functional.scaled_dot_product_attention(
+					queries, keys, values, attn_mask=float_mask, dropout_p=dropout_p
+				)
+			elif num_past == 0:
+				context = nn.functional.scaled_dot_product_attention(
+					queries, keys, values, dropout_p=dropout_p, is_causal=True
+				)
+			elif num_tokens == 1:
+				# A single new token attends to every cached token
+				context = nn.functional.scaled_dot_product_attention(
+					queries, keys, values, dropout_p=dropout_p
+				)
+			else:
+				# is_causal assumes the queries start at position 0, so the cached offset needs an explicit mask
+				attn_mask = ~self.mask[num_past:num_past + num_tokens, :num_keys].bool()
+				context = nn.functional.scaled_dot_product_attention(
+					queries, keys, values, attn_mask=attn_mask, dropout_p=dropout_p
+				)
+		else:
+			# Attention scores 
+			attn_scores = queries @ keys.transpose(2, 3)
+
+			# Mask (the new queries are located after the cached tokens)
+			mask_bool = self.mask[num_past:num_past + num_tokens, :num_keys].bool()
+			if attn_mask is not None:
+				# Finite minimum, so the rows of padded queries do not turn into NaN
+				attn_scores.masked_fill_(mask_bool | ~attn_mask, torch.finfo(attn_scores.dtype).min)
+			else:
+				attn_scores.masked_fill_(mask_bool, -torch.inf)
+
+			# Attention weights
+			attn_weights = torch.softmax(attn_scores / keys.shape[-1]**0.5, dim=-1)
+			attn_weights = self.dropout(attn_weights)
+			context = attn_weights @ values
 
 		# Context
-		context = (attn_weights @ values).transpose(1, 2) 
+		context = context.transpose(1, 2) 
 
 		# Combine all the heads 
 		context = context.contiguous().view(b, num_tokens, self.d_out)
@@ -78,19 +266,21 @@ class TransformerBlock(nn.Module):
 			context_length=cfg["context_length"],
 			num_heads=cfg["n_heads"], 
 			dropout=cfg["drop_rate"],
-			qkv_bias=cfg["qkv_bias"]
+			qkv_bias=cfg["qkv_bias"],
+			attn_backend=cfg.get("attn_backend", "manual"),
+			fused_qkv=cfg.get("fused_qkv", False)
 		)
 
-		self.ff = FeedForward(cfg["emb_dim"])
-		self.norm1 = LayerNorm(cfg["emb_dim"])
-		self.norm2 = LayerNorm(cfg["emb_dim"])
+		self.ff = FeedForward(cfg["emb_dim"], fused=cfg.get("fused_ops", False))
+		self.norm1 = LayerNorm(cfg["emb_dim"], fused=cfg.get("fused_ops", False))
+		self.norm2 = LayerNorm(cfg["emb_dim"], fused=cfg.get("fused_ops", False))
 		self.drop_shortcut = nn.Dropout(cfg["drop_rate"])
 
 	# Data flow inside the transformer block 
-	def forward(self, x):
+	def forward(self, x, kv_cache=None, layer_idx=0, attn_mask=None):
 		shortcut = x
 		x = self.norm1(x)
-		x = self.att(x)
+		x = self.att(x, kv_cache=kv_cache, layer_idx=layer_idx, attn_mask=attn_mask)
 		x = self.drop_shortcut(x)
 		x = x + shortcut 
 
@@ -103,25 +293,31 @@ class TransformerBlock(nn.Module):
 
 
 
+# fused: single kernel (nn.functional.gelu) instead of the reference tensor ops, same tanh approximation
 class GELU(nn.Module): 
-	def __init__(self):
+	def __init__(self, fused=False):
 		super().__init__()
+		self.fused = fused
 
 	def forward(self, x):
-		return 0.5 * x * (1 + torch.tanh(
+		# Computed in fp32 also on mixed precision (no-op for fp32 inputs)
+		x_float = x.float()
+		if self.fused:
+			return nn.functional.gelu(x_float, approximate="tanh").to(x.dtype)
+		return (0.5 * x_float * (1 + torch.tanh(
 			torch.sqrt(torch.tensor(2.0 / torch.pi)) * 
-			(x + 0.044715 * torch.pow(x, 3))
-		))
+			(x_float + 0.044715 * torch.pow(x_float, 3))
+		))).to(x.dtype)
 
 
 
 
 class FeedForward(nn.Module):
-	def __init__(self, emb_dim):
+	def __init__(self, emb_dim, fused=False):
 		super().__init__()
 		self.layers = nn.Sequential(
 			nn.Linear(emb_dim, 4 * emb_dim),
-			GELU(),
+			GELU(fused),
 			nn.Linear(4*emb_dim, emb_dim)
 		)
 
@@ -132,18 +328,24 @@ class FeedForward(nn.Module):
 
 
 
+# fused: single kernel (nn.functional.layer_norm) instead of the reference tensor ops, same parameters
 class LayerNorm(nn.Module):
-	def __init__(self, emb_dim):
+	def __init__(self, emb_dim, fused=False):
 		super().__init__()
 		self.eps = 1e-5								# Done to avoid division by 0
 		self.scale = nn.Parameter(torch.ones(emb_dim))
 		self.shift = nn.Parameter(torch.ones(emb_dim))
+		self.fused = fused
 
 	def forward(self, x):
-		mean = x.mean(dim=-1, keepdim=True)
-		var = x.var(dim=-1, keepdim=True, unbiased=False)
-		norm_x = (x - mean) / torch.sqrt(var + self.eps)
-		return self.scale * norm_x + self.shift
+		# Statistics in fp32 also on mixed precision (no-op for fp32 inputs)
+		x_float = x.float()
+		if self.fused:
+			return nn.functional.layer_norm(x_float, self.scale.shape, self.scale, self.shift, self.eps).to(x.dtype)
+		mean = x_float.mean(dim=-1, keepdim=True)
+		var = x_float.var(dim=-1, keepdim=True, unbiased=False)
+		norm_x = (x_float - mean) / torch.sqrt(var + self.eps)
+		return (self.scale * norm_x + self.shift).to(x.dtype)
 
 
 
@@ -161,53 +363,294 @@ class GPTModel(nn.Module):
       *[TransformerBlock(cfg) for I in range(cfg["n_layers"])]
     )
     # Layer normalization 
-    self.final_norm = LayerNorm(cfg["emb_dim"])
+    self.final_norm = LayerNorm(cfg["emb_dim"], fused=cfg.get("fused_ops", False))
     # UnEmbedding
     self.out_head = nn.Linear(
       cfg["emb_dim"], cfg["vocab_size"], bias=False
     )
-
-  def forward(self, in_idx):
+    # Activation checkpointing, recompute the activations of each block on the backward pass instead of storing them
+    self.grad_checkpointing = cfg.get("grad_checkpointing", False)
+    self.context_length = cfg["context_length"]
+
+  """
+    position_ids: optional (batch_size, seq_len) positions, e.g. for left padded batches.
+    attn_mask: optional boolean mask where the attention is allowed (see MultiHeadAttention).
+    positions: only compute the outputs of these positions, an int (e.g. -1 for the last token), a slice
+      (e.g. slice(-4, None) for the last 4 tokens) or a (batch_size,) tensor with one position per sequence.
+      The outputs then have shape (batch_size, 1, ...), or the length of the slice.
+    return_hidden: return the normalized hidden states instead of the logits.
+  """
+  def forward(self, in_idx, kv_cache=None, pos_offset=None, position_ids=None, attn_mask=None, positions=None, return_hidden=False):
     batch_size, seq_len = in_idx.shape
+    if position_ids is None:
+      # With a kv cache the new tokens are located right after the cached ones
+      if pos_offset is None:
+        pos_offset = 0 if kv_cache is None else len(kv_cache)
+      position_ids = torch.arange(pos_offset, pos_offset + seq_len, device=in_idx.device)
     # Process the embeddings 
     tok_embeds = self.tok_emb(in_idx)     # Work embedding 
     # The positional, if the seq_len is smaller than the context_length, we use the seq_len.. 
-    pos_embeds = self.pos_emb(torch.arange(seq_len, device=in_idx.device))
+    pos_embeds = self.pos_emb(position_ids)
     x = tok_embeds + pos_embeds
     # Regularization
     x = self.drop_emb(x)
     # Transformer blocks 
-    x = self.trf_blocks(x)
+    for layer_idx, block in enumerate(self.trf_blocks):
+      if self.grad_checkpointing and self.training and kv_cache is None:
+        x = checkpoint(block, x, use_reentrant=False, layer_idx=layer_idx, attn_mask=attn_mask)
+      else:
+        x = block(x, kv_cache=kv_cache, layer_idx=layer_idx, attn_mask=attn_mask)
+    # Only the selected positions go through the final norm and the (vocab_size wide) output head
+    if isinstance(positions, int):
+      x = x[:, [positions]]
+    elif isinstance(positions, slice):
+      x = x[:, positions]
+    elif positions is not None:
+      x = x[torch.arange(batch_size, device=x.device), positions].unsqueeze(1)
     # MLP
     x = self.final_norm(x)
+    if return_hidden:
+      return x
     # Logits for the next token prediction
     logits = self.out_head(x)
     return logits
 
+  # Empty cache for incremental decoding with this model
+  def new_kv_cache(self):
+    return KVCache(len(self.trf_blocks))
+
+
+
+
+
+# ================================================== Tokenization ==================================================
+# Position after a single new line between two non-whitespace characters, the tokenizer never merges across it
+# (a run of whitespace like "\n\n" or " \n" is a token of its own and can not be split)
+TEXT_SPLIT_PATTERN = re.compile(r"(?<=\S)\n(?=\S)")
+# Part of the cache names, changed when the tokenization of the cached files changes
+TOKEN_CACHE_VERSION = 2
+
+
+
+"""
+  token_cache_path
+    Path of the cached tokens of some content, named by the hash of the content and of the tokenizer
+    so any change of them creates a new entry.
+"""
+def token_cache_path(content, tokenizer, cache_dir, suffix):
+	digest = hashlib.sha256()
+	digest.update(tokenizer.name.encode("utf-8"))
+	digest.update(f"\0{TOKEN_CACHE_VERSION}\0".encode("utf-8"))
+	digest.update(content.encode("utf-8"))
+	return os.path.join(cache_dir, f"{tokenizer.name}-{digest.hexdigest()[:32]}{suffix}")
+
+
+
+# Writes through a temporary file, so concurrent processes never read a partial cache entry
+def atomic_write(file_path, write_fn):
+	os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+	tmp_path = f"{file_path}.{os.getpid()}.tmp"
+	with open(tmp_path, "wb") as file:
+		write_fn(file)
+	os.replace(tmp_path, file_path)
+
+
+
+# Splits a long text into about num_chunks pieces on positions where the tokens do not change
+def split_text(txt, num_chunks):
+	chunks, start = [], 0
+	for i in range(1, num_chunks):
+		match = TEXT_SPLIT_PATTERN.search(txt, max(start, i * len(txt) // num_chunks))
+		if match is None:
+			break
+		chunks.append(txt[start:match.end()])
+		start = match.end()
+	chunks.append(txt[start:])
+	return chunks
+
+
+
+"""
+  encode_text
+    Tokenizes a (long) text in parallel, the text is split on new lines and the pieces are encoded by
+    the tiktoken threads. Returns the token ids as a uint16 array (the GPT-2 vocabulary fits in 16 bits).
+    With a cache_dir the tokens are stored as a token file (see TokenFileDataset) and reused.
+"""
+def encode_text(txt, tokenizer, cache_dir=None, num_threads=8):
+	if cache_dir is not None:
+		return np.fromfile(cached_token_file(txt, tokenizer, cache_dir, num_threads), dtype=np.uint16)
+	encoded_chunks = tokenizer.encode_batch(
+		split_text(txt, num_threads * 4), num_threads=num_threads, allowed_special={"<|endoftext|>"}
+	)
+	return np.fromiter((token for chunk in encoded_chunks for token in chunk), dtype=np.uint16)
+
+
+
+# Path of the token file of the text in the cache, tokenized only if it is not there yet
+def cached_token_file(txt, tokenizer, cache_dir, num_threads=8):
+	cache_path = token_cache_path(txt, tokenizer, cache_dir, ".bin")
+	if not os.path.exists(cache_path):
+		token_ids = encode_text(txt, tokenizer, num_threads=num_threads)
+		atomic_write(cache_path, token_ids.tofile)
+	return cache_path
+
+
+
+"""
+  encode_texts
+    Tokenizes a list of texts in parallel (tiktoken threads). With a cache_dir the token ids are stored as 
+    flat uint16 tokens plus offsets and loaded from there the next time the same texts are encoded.
+"""
+def encode_texts(texts, tokenizer, cache_dir=None, num_threads=8):
+	texts = list(texts)
+	if cache_dir is None:
+		return tokenizer.encode_batch(texts, num_threads=num_threads)
+
+	cache_path = token_cache_path("\0".join(texts), tokenizer, cache_dir, ".npz")
+	if not os.path.exists(cache_path):
+		encoded_texts = tokenizer.encode_batch(texts, num_threads=num_threads)
+		tokens = np.fromiter((token for encoded in encoded_texts for token in encoded), dtype=np.uint16)
+		offsets = np.cumsum([0] + [len(encoded) for encoded in encoded_texts], dtype=np.int64)
+		atomic_write(cache_path, lambda file: np.savez(file, tokens=tokens, offsets=offsets))
+		return encoded_texts
+
+	cached = np.load(cache_path)
+	tokens, offsets = cached["tokens"], cached["offsets"]
+	return [tokens[offsets[i]:offsets[i + 1]].tolist() for i in range(len(offsets) - 1)]
 
 
 
 
 class GPTDataset(Dataset):
-	def __init__(self, txt, tokenizer, max_length, stride):
-		self.input_ids = []
-		self.target_ids = []
-		# tokenize text 
-		token_ids = tokenizer.encode(txt, allowed_special={"<|endoftext|>"})
-		# Encode the chuncks giving jumps of stride size 
-		for i in range(0, len(token_ids) - max_length, stride):
-			input_chunk = token_ids[i: i+max_length]
-			target_chunk = token_ids[i+1: i+max_length+1]
-			self.input_ids.append(torch.tensor(input_chunk))
-			self.target_ids.append(torch.tensor(target_chunk)) 
+	def __init__(self, txt, tokenizer, max_length, stride, cache_dir=None):
+		self.max_length = max_length
+		self.stride = stride
+		# tokenize text (or load it from the token cache), the chunks are sliced from the flat tokens when requested
+		self.token_ids = torch.from_numpy(encode_text(txt, tokenizer, cache_dir).astype(np.int64))
+		# Chuncks giving jumps of stride size 
+		self.num_chunks = len(range(0, len(self.token_ids) - max_length, stride))
 
 	# Number of training examples of the current text
 	def __len__(self):
-		return len(self.input_ids)
+		return self.num_chunks
 
 	# The requestes chunk from the text both inputs and targets
 	def __getitem__(self, idx):
-		return self.input_ids[idx], self.target_ids[idx]
+		i = idx * self.stride
+		return self.token_ids[i: i+self.max_length], self.token_ids[i+1: i+self.max_length+1]
+
+
+
+
+"""
+  write_token_file
+    Tokenizes the text once and stores the token ids as a flat uint16 file on disk
+    (the GPT-2 vocabulary fits in 16 bits). Returns the number of tokens.
+"""
+def write_token_file(txt, tokenizer, file_path):
+	token_ids = encode_text(txt, tokenizer)
+	token_ids.tofile(file_path)
+	return len(token_ids)
+
+
+
+"""
+  TokenFileDataset
+    Same chunks as GPTDataset, sliced on the fly from a memory-mapped token file (see write_token_file),
+    the memory does not grow with the size of the corpus.
+"""
+class TokenFileDataset(Dataset):
+	def __init__(self, file_path, max_length, stride):
+		self.file_path = file_path
+		self.max_length = max_length
+		self.stride = stride
+		self.tokens = None
+		num_tokens = os.path.getsize(file_path) // np.dtype(np.uint16).itemsize
+		self.num_chunks = len(range(0, num_tokens - max_length, stride))
+
+	def __len__(self):
+		return self.num_chunks
+
+	def __getitem__(self, idx):
+		# Mapped on first use, so every DataLoader worker maps the file itself
+		if self.tokens is None:
+			self.tokens = np.memmap(self.file_path, dtype=np.uint16, mode="r")
+		i = idx * self.stride
+		chunk = torch.from_numpy(self.tokens[i: i+self.max_length+1].astype(np.int64))
+		return chunk[:-1], chunk[1:]
+
+
+
+"""
+  TokenShardDataset
+    Streams the chunks of several token files (shards) one after the other. The shards are split between 
+    the distributed processes and the DataLoader workers, so there should be at least as many shards as 
+    processes x workers. With shuffle the order of the shards changes on every epoch (set_epoch).
+    batch_size and num_workers must be the ones of the DataLoader: every worker only yields whole batches
+    and, on distributed training, every process yields the number of batches of the process with the
+    fewest, so no process leaves the epoch (and the gradient all-reduce) before the others.
+"""
+class TokenShardDataset(IterableDataset):
+	def __init__(self, file_paths, max_length, stride, shuffle=False, seed=123, batch_size=1, num_workers=0):
+		self.file_paths = list(file_paths)
+		self.max_length = max_length
+		self.stride = stride
+		self.shuffle = shuffle
+		self.seed = seed
+		self.batch_size = batch_size
+		self.num_workers = max(1, num_workers)
+		self.epoch = 0
+
+	def set_epoch(self, epoch):
+		self.epoch = epoch
+
+	# Shards of a worker of a process on the current epoch
+	def worker_file_paths(self, rank, world_size, worker_id):
+		file_paths = self.file_paths[rank::world_size]
+		if self.shuffle:
+			random.Random(self.seed + self.epoch).shuffle(file_paths)
+		return file_paths[worker_id::self.num_workers]
+
+	def num_file_chunks(self, file_path):
+		num_tokens = os.path.getsize(file_path) // np.dtype(np.uint16).itemsize
+		return len(range(0, num_tokens - self.max_length, self.stride))
+
+	# Number of batches of every worker of this process (the shard sizes of all the processes are known
+	# from the files, so every process computes the same minimum without communicating)
+	def worker_num_batches(self):
+		rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+		num_batches = [
+			[
+				sum(self.num_file_chunks(file_path) for file_path in self.worker_file_paths(process, world_size, worker_id)) // self.batch_size
+				for worker_id in range(self.num_workers)
+			]
+			for process in range(world_size)
+		]
+		worker_batches = num_batches[rank]
+		# Drop batches from the workers with the most until the process has as many as the one with the fewest
+		num_dropped = sum(worker_batches) - min(sum(batches) for batches in num_batches)
+		for _ in range(num_dropped):
+			worker_batches[worker_batches.index(max(worker_batches))] -= 1
+		return worker_batches
+
+	# Number of chunks of this process (whole batches, so len(DataLoader) is exact)
+	def __len__(self):
+		return sum(self.worker_num_batches()) * self.batch_size
+
+	def __iter__(self):
+		rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_initialized() else (0, 1)
+		worker_info = get_worker_info()
+		worker_id = 0 if worker_info is None else worker_info.id
+		num_chunks = self.worker_num_batches()[worker_id] * self.batch_size
+
+		for file_path in self.worker_file_paths(rank, world_size, worker_id):
+			tokens = np.memmap(file_path, dtype=np.uint16, mode="r")
+			for i in range(0, len(tokens) - self.max_length, self.stride):
+				if num_chunks == 0:
+					return
+				num_chunks -= 1
+				chunk = torch.from_numpy(tokens[i: i+self.max_length+1].astype(np.int64))
+				yield chunk[:-1], chunk[1:]
 
 
 
@@ -244,11 +687,11 @@ def train_test_split(text_data, train_ratio=0.9):
 
 
 
-def create_data_loader(txt, batch_size=6, max_length=256, stride=256, shuffle=True, drop_last=True, num_workers=0):
+def create_data_loader(txt, batch_size=6, max_length=256, stride=256, shuffle=True, drop_last=True, num_workers=0, cache_dir=None):
 	# Tokenizer use on GPT2
   tokenizer = tiktoken.get_encoding("gpt2")
 	# From text to dataloader
-  dataset = GPTDataset(txt, tokenizer, max_length, stride)
+  dataset = GPTDataset(txt, tokenizer, max_length, stride, cache_dir)
   dataloader = DataLoader(
     dataset,
     batch_size=batch_size,
@@ -261,6 +704,25 @@ def create_data_loader(txt, batch_size=6, max_length=256, stride=256, shuffle=Tr
 
 
 
+# From token files (see write_token_file) to dataloader, a list of files is streamed shard by shard
+def create_token_file_data_loader(file_path, batch_size=6, max_length=256, stride=256, shuffle=True, drop_last=True, num_workers=0):
+	if isinstance(file_path, (list, tuple)):
+		dataset = TokenShardDataset(file_path, max_length, stride, shuffle=shuffle, batch_size=batch_size, num_workers=num_workers)
+		shuffle = False
+	else:
+		dataset = TokenFileDataset(file_path, max_length, stride)
+	dataloader = DataLoader(
+		dataset,
+		batch_size=batch_size,
+		shuffle=shuffle,
+		drop_last=drop_last,
+		num_workers=num_workers
+	)
+	return dataloader
+
+
+
+
 def create_tokenizer():
   return tiktoken.get_encoding("gpt2")
 
@@ -268,36 +730,207 @@ def create_tokenizer():
 
 
 
-def text_generation(model, idx, num_token_generation, context_size, temperature=0.0, top_k=None, eos_id=None):
+def select_next_token(logits, temperature=0.0, top_k=None):
+	# Only take into account the top K words on the next word selection
+	if top_k is not None:
+		top_logits, _ = torch.topk(logits, top_k)
+		min_val = top_logits[:, -1:]
+		logits = torch.where(
+			logits < min_val,
+			torch.tensor(float('-inf')).to(logits.device),
+			logits
+		)
+	# Modify the final distribution with the temp
+	if temperature > 0.0:
+		logits = logits / temperature
+		probs = torch.softmax(logits, dim=-1)
+		idx_next = torch.multinomial(probs, num_samples=1)
+	else: 
+		idx_next = torch.argmax(logits, dim=-1, keepdim=True)
+	return idx_next
+
+
+
+"""
+  stream_text_generation
+    Generator version of text_generation, yields every new token (shape (b, 1)) as soon as it 
+    is selected. With use_cache=True the prompt is processed once and every following step only 
+    runs the newest token through the model, reusing the keys/values of the previous ones.
+    prefix_cache: optional PrefixCache (with use_cache=True), the prefill resumes from the longest
+    cached prefix of the prompt and stores the prompt.
+"""
+def stream_text_generation(model, idx, num_token_generation, context_size, temperature=0.0, top_k=None, eos_id=None, use_cache=False, prefix_cache=None):
+	kv_cache = model.new_kv_cache() if use_cache else None
 	for _ in range(num_token_generation):
-		idx_cond = idx[:, -context_size:]
 		with torch.no_grad():
 			# Generate the next tokens
-			logits = model(idx_cond)
+			if kv_cache is None:
+				logits = model(idx[:, -context_size:], positions=-1)
+			elif len(kv_cache) >= context_size:
+				# Refill when the window has to slide past the context length
+				kv_cache.reset()
+				logits = model(idx[:, -context_size:], kv_cache=kv_cache, positions=-1)
+			elif len(kv_cache) == 0:
+				# Prefill (at least the last token of the prompt is processed, for its logits)
+				prompt = idx[0, -context_size:].tolist()
+				cached = None if prefix_cache is None else prefix_cache.lookup(prompt, max_tokens=len(prompt) - 1)
+				if cached is not None:
+					kv_cache = cached
+				logits = model(idx[:, -context_size:][:, len(kv_cache):], kv_cache=kv_cache, positions=-1)
+				if prefix_cache is not None:
+					prefix_cache.store(prompt, kv_cache)
+			else:
+				logits = model(idx[:, -1:], kv_cache=kv_cache, positions=-1)
 		logits = logits[:, -1, :]
-		# Only take into account the top K words on the next word selection
-		if top_k is not None:
-			top_logits, _ = torch.topk(logits, top_k)
-			min_val = top_logits[:, -1]
-			logits = torch.where(
-				logits < min_val,
-				torch.tensor(float('-inf')).to(logits.device),
-				logits
-			)
-		# Modify the final distribution with the temp
-		if temperature > 0.0:
-			logits = logits / temperature
-			probs = torch.softmax(logits, dim=-1)
-			idx_next = torch.multinomial(probs, num_samples=1)
-		else: 
-			idx_next = torch.argmax(logits, dim=-1, keepdim=True)
+		idx_next = select_next_token(logits, temperature, top_k)
 		if idx_next == eos_id:
 			break
 		idx = torch.cat((idx, idx_next), dim=1)
+		yield idx_next
+
+
+
+def text_generation(model, idx, num_token_generation, context_size, temperature=0.0, top_k=None, eos_id=None, use_cache=False, prefix_cache=None):
+	for idx_next in stream_text_generation(model, idx, num_token_generation, context_size, temperature, top_k, eos_id, use_cache, prefix_cache):
+		idx = torch.cat((idx, idx_next), dim=1)
+	return idx
+
+
+
+"""
+  stream_speculative_generation
+    Greedy generation (temperature 0.0) of a single sequence where a small draft_model (same tokenizer)
+    proposes num_draft_tokens tokens and the model checks all of them in one forward pass. The proposed
+    tokens are accepted up to the first one the model would not have chosen, which is replaced by the
+    token of the model, so the output is the same as the greedy stream_text_generation of the model.
+    Once the sequence and the proposed tokens do not fit in the context window anymore, the generation
+    continues as stream_text_generation (sliding window), so long prompts give the same output as well.
+    Yields every new token (shape (1, 1)).
+"""
+def stream_speculative_generation(model, draft_model, idx, num_token_generation, context_size, num_draft_tokens=4, eos_id=None):
+	kv_cache, draft_kv_cache = model.new_kv_cache(), draft_model.new_kv_cache()
+	num_generated = 0
+	while num_generated < num_token_generation:
+		if idx.shape[1] + num_draft_tokens > context_size:
+			# No room for the proposed tokens
+			yield from stream_text_generation(model, idx, num_token_generation - num_generated, context_size, eos_id=eos_id, use_cache=True)
+			return
+
+		with torch.no_grad():
+			# The draft model proposes the next tokens one by one
+			draft = idx
+			for _ in range(num_draft_tokens):
+				logits = draft_model(draft[:, len(draft_kv_cache):], kv_cache=draft_kv_cache, positions=-1)
+				draft = torch.cat((draft, torch.argmax(logits[:, -1, :], dim=-1, keepdim=True)), dim=1)
+			draft_tokens = draft[:, idx.shape[1]:]
+
+			# Token of the model after the last token and after every proposed token, in one forward pass
+			logits = model(draft[:, len(kv_cache):], kv_cache=kv_cache, positions=slice(-(num_draft_tokens + 1), None))
+			predicted = torch.argmax(logits, dim=-1)
+
+		matches = (draft_tokens == predicted[:, :-1]).squeeze(0).tolist()
+		num_accepted = matches.index(False) if False in matches else num_draft_tokens
+		new_tokens = torch.cat((draft_tokens[:, :num_accepted], predicted[:, num_accepted:num_accepted + 1]), dim=1)
+
+		# Forget the keys/values of the rejected tokens
+		kv_cache.truncate(idx.shape[1] + num_accepted)
+		draft_kv_cache.truncate(min(len(draft_kv_cache), idx.shape[1] + num_accepted))
+
+		for idx_next in new_tokens.split(1, dim=1):
+			if idx_next == eos_id or num_generated == num_token_generation:
+				return
+			idx = torch.cat((idx, idx_next), dim=1)
+			num_generated += 1
+			yield idx_next
+
+
+
+def speculative_text_generation(model, draft_model, idx, num_token_generation, context_size, num_draft_tokens=4, eos_id=None):
+	for idx_next in stream_speculative_generation(model, draft_model, idx, num_token_generation, context_size, num_draft_tokens, eos_id):
+		idx = torch.cat((idx, idx_next), dim=1)
 	return idx
 
 
 
+"""
+  left_pad_batch
+    Left pads the sequences (lists of token ids) after num_cached tokens already in the kv cache,
+    so the last token of every sequence is on the last column. Returns the token ids, the padding
+    mask (True on the cached and the real tokens) and the position ids of the new columns.
+"""
+def left_pad_batch(sequences, num_cached, pad_token_id, device):
+	batch_size = len(sequences)
+	max_length = max(len(sequence) for sequence in sequences) - num_cached
+	idx = torch.full((batch_size, max_length), pad_token_id, dtype=torch.long)
+	pad_mask = torch.zeros((batch_size, max_length), dtype=torch.bool)
+	for i, sequence in enumerate(sequences):
+		idx[i, max_length - len(sequence) + num_cached:] = torch.tensor(sequence[num_cached:], dtype=torch.long)
+		pad_mask[i, max_length - len(sequence) + num_cached:] = True
+	idx, pad_mask = idx.to(device), pad_mask.to(device)
+	# Positions start at 0 on the first real token of each sequence (right after the cached prefix)
+	position_ids = num_cached + (pad_mask.long().cumsum(dim=-1) - 1).clamp(min=0)
+	pad_mask = torch.cat((torch.ones((batch_size, num_cached), dtype=torch.bool, device=device), pad_mask), dim=1)
+	return idx, pad_mask, position_ids
+
+
+
+"""
+  batch_text_generation
+    Generates the continuation of several prompts (lists of token ids) together. The prompts are left
+    padded, the padding is hidden from the attention and every sequence stops on its own eos_id.
+    Like stream_text_generation, the prompts keep up to context_size tokens and the window slides
+    (the cache is refilled) once the generated tokens reach the context length.
+    Returns the generated token ids of each prompt (without the prompt).
+    prefix_cache: optional PrefixCache, the prompts resume from the longest cached prefix they all share
+    (the rest of each prompt is left padded after it) and the longest prompt is stored.
+"""
+def batch_text_generation(model, prompts, num_token_generation, context_size, device, temperature=0.0, top_k=None, eos_id=None, pad_token_id=50256, prefix_cache=None):
+	sequences = [list(prompt[-context_size:]) for prompt in prompts]
+	batch_size = len(sequences)
+
+	kv_cache, num_cached = None, 0
+	if prefix_cache is not None:
+		shared_prefix = sequences[0][:common_prefix_length(*sequences)]
+		kv_cache = prefix_cache.lookup(shared_prefix, max_tokens=min(len(sequence) for sequence in sequences) - 1, batch_size=batch_size)
+		num_cached = 0 if kv_cache is None else len(kv_cache)
+	if kv_cache is None:
+		kv_cache = model.new_kv_cache()
+	idx, pad_mask, position_ids = left_pad_batch(sequences, num_cached, pad_token_id, device)
+
+	generated = [[] for _ in prompts]
+	finished = [False] * batch_size
+	for step in range(num_token_generation):
+		if len(kv_cache) >= context_size:
+			# Refill when the window has to slide past the context length
+			kv_cache.reset()
+			idx, pad_mask, position_ids = left_pad_batch([sequence[-context_size:] for sequence in sequences], 0, pad_token_id, device)
+		with torch.no_grad():
+			logits = model(idx, kv_cache=kv_cache, position_ids=position_ids, attn_mask=pad_mask[:, None, None, :], positions=-1)
+		if step == 0 and prefix_cache is not None:
+			# The keys/values of a longest prompt have no padding in between
+			longest = max(range(batch_size), key=lambda i: len(sequences[i]))
+			prefix_cache.store(sequences[longest], kv_cache, row=longest)
+		idx_next = select_next_token(logits[:, -1, :], temperature, top_k)
+
+		for i, token in enumerate(idx_next.squeeze(-1).tolist()):
+			sequences[i].append(token)
+			if finished[i]:
+				continue
+			if token == eos_id:
+				finished[i] = True
+			else:
+				generated[i].append(token)
+		if all(finished):
+			break
+
+		# Only the new tokens are processed on the next step
+		idx = idx_next
+		pad_mask = torch.cat((pad_mask, torch.ones_like(idx_next, dtype=torch.bool)), dim=1)
+		position_ids = position_ids[:, -1:] + 1
+	return generated
+
+
+
 #  ===== Text Manipulation =====
 def text_to_token_ids(text, tokenizer):
     encoded = tokenizer.encode(text, allowed_special={'<|endoftext|>'})
@@ -312,16 +945,62 @@ def token_ids_to_text(token_ids, tokenizer):
 
 
 
+"""
+  StreamDecoder
+    Incremental detokenization of streamed tokens. A token can end in the middle of a multi-byte
+    character, those bytes are kept until the character is complete.
+"""
+class StreamDecoder:
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    # Text completed by the new token (can be empty)
+    def decode(self, token_id):
+        return self.decoder.decode(self.tokenizer.decode_single_token_bytes(token_id))
+
+    # Remaining text once the stream is over
+    def flush(self):
+        return self.decoder.decode(b"", final=True)
+
+
+
 # ================================================== Training ==================================================
-def calc_loss_batch(input_batch, target_batch, model, device):
+# Mixed precision types, precision=None keeps everything in fp32
+PRECISIONS = {"bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+
+def autocast_context(device, precision=None):
+	if precision is None:
+		return nullcontext()
+	return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision])
+
+
+
+# Block-diagonal causal attention of packed examples, a new example starts where the position goes back to 0
+def packed_attention_mask(position_ids):
+	segment_ids = (position_ids == 0).cumsum(dim=-1)
+	return (segment_ids.unsqueeze(-1) == segment_ids.unsqueeze(-2)).unsqueeze(1)
+
+
+
+# position_ids: positions of packed batches (see GPTA.PackedInstructionDataset)
+def calc_loss_batch(input_batch, target_batch, model, device, precision=None, position_ids=None):
 	input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-	logits = model(input_batch)
-	loss = torch.nn.functional.cross_entropy(logits.flatten(0, 1), target_batch.flatten())
+	packing = {}
+	if position_ids is not None:
+		position_ids = position_ids.to(device)
+		packing = {"position_ids": position_ids, "attn_mask": packed_attention_mask(position_ids)}
+	with autocast_context(device, precision):
+		logits = model(input_batch, **packing)
+	# Loss in fp32
+	loss = torch.nn.functional.cross_entropy(logits.float().flatten(0, 1), target_batch.flatten())
 	return loss
 
 
 
-def calc_loss_loader(data_loader, model, device, num_batches=None):
+def calc_loss_loader(data_loader, model, device, num_batches=None, precision=None):
 	total_loss = 0.
 	if(len(data_loader) == 0):
 		return float("nan")
@@ -329,9 +1008,9 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
 		num_batches = len(data_loader)
 	else:
 		num_batches = min(num_batches, len(data_loader))
-	for i, (input_batch, target_batch) in enumerate(data_loader):
+	for i, (input_batch, target_batch, *packing) in enumerate(data_loader):
 		if i < num_batches:
-			loss = calc_loss_batch(input_batch, target_batch, model, device)
+			loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *packing)
 			total_loss += loss.item()
 		else:
 			break
@@ -339,17 +1018,33 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
 
 
 
+# Loss of the same batches in fp32 and in mixed precision, to check the precision does not change the results
+def check_loss_parity(model, data_loader, device, precision, num_batches=5):
+	model.eval()
+	with torch.no_grad():
+		loss = calc_loss_loader(data_loader, model, device, num_batches=num_batches)
+		mixed_loss = calc_loss_loader(data_loader, model, device, num_batches=num_batches, precision=precision)
+	model.train()
+	if is_main_process():
+		print(f"Loss parity: fp32 {loss:.4f} | {precision} {mixed_loss:.4f} | difference {abs(mixed_loss - loss):.4f}")
+	return loss, mixed_loss
+
+
+
+# On distributed training the losses are averaged over all the processes
 def evaluate_model(model, train_loader, val_loader, device, eval_iter):
 	model.eval()
 	with torch.no_grad():
 		train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
 		val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
 	model.train()
-	return train_loss, val_loss
+	return all_reduce_mean(train_loss), all_reduce_mean(val_loss)
 
 
 
 def generate_and_print_sample(model, tokenizer, device, start_context):
+	# Generation on a single process, without the synchronization of the distributed model
+	model = unwrap_model(model)
 	model.eval()
 	context_size = model.pos_emb.weight.shape[0]
 	encoded = text_to_token_ids(start_context, tokenizer).to(device)
@@ -369,18 +1064,40 @@ def generate_and_print_sample(model, tokenizer, device, start_context):
 
 
 
-def train_model_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, start_context, tokenizer):
+"""
+  train_model_simple
+    precision: None (fp32), "bf16" or "fp16" mixed precision of the forward pass. fp16 scales the loss
+    to avoid the underflow of the gradients.
+    accumulation_steps: micro-batches (DataLoader batches) accumulated on every optimizer step, the 
+    effective batch size is batch_size * accumulation_steps. eval_freq counts optimizer steps.
+"""
+def train_model_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, start_context, tokenizer, precision=None, accumulation_steps=1):
 	train_losses, val_losses, track_tokens_seen = [], [], []
 	tokens_seen, global_step = 0, -1
+	scaler = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+	if precision is not None:
+		check_loss_parity(model, val_loader, device, precision, num_batches=eval_iter)
 
 	# Main training loop
 	for epoch in range(num_epochs):
-		for input_batch, target_batch in train_loader:
-			optimizer.zero_grad() # Reset loss gradients from previous batch iteration
-			loss = calc_loss_batch(input_batch, target_batch, model, device)
-			loss.backward() # Calculate loss gradients
-			optimizer.step() # Update model weights using loss gradients
+		set_sampler_epoch(train_loader, epoch)
+		num_batches = len(train_loader)
+		optimizer.zero_grad() # Reset loss gradients
+		for i, (input_batch, target_batch, *packing) in enumerate(train_loader):
+			optimizer_step = (i + 1) % accumulation_steps == 0 or i + 1 == num_batches
+			# The last group of the epoch can have fewer micro-batches
+			group_size = min(accumulation_steps, num_batches - (i - i % accumulation_steps))
+			# The gradients of a distributed model are only synchronized on the optimizer steps
+			with no_sync_context(model, optimizer_step):
+				loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *packing)
+				scaler.scale(loss / group_size).backward() # Accumulate the loss gradients of the micro-batches
 			tokens_seen += input_batch.numel()
+			if not optimizer_step:
+				continue
+
+			scaler.step(optimizer) # Update model weights using loss gradients
+			scaler.update()
+			optimizer.zero_grad() # Reset loss gradients for the next step
 			global_step += 1
 
 			if global_step % eval_freq == 0:
@@ -388,11 +1105,13 @@ def train_model_simple(model, train_loader, val_loader, optimizer, device, num_e
 				train_losses.append(train_loss)
 				val_losses.append(val_loss)
 				track_tokens_seen.append(tokens_seen)
-				print(f"Ep {epoch+1} (Step {global_step:06d}): "
-              f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+				if is_main_process():
+					print(f"Ep {epoch+1} (Step {global_step:06d}): "
+                f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
 		
 		# Generate a sample text for each epoch
-		generate_and_print_sample(model, tokenizer, device, start_context)
+		if is_main_process():
+			generate_and_print_sample(model, tokenizer, device, start_context)
 		
 	return train_losses, val_losses, track_tokens_seen
 
@@ -400,6 +1119,57 @@ def train_model_simple(model, train_loader, val_loader, optimizer, device, num_e
 
 
 
+# ================================================== Distributed training ==================================================
+# Only the first process prints and saves
+def is_main_process():
+	return not dist.is_initialized() or dist.get_rank() == 0
+
+
+
+def unwrap_model(model):
+	if isinstance(model, nn.parallel.DistributedDataParallel):
+		return model.module
+	return model
+
+
+
+# Average of a value over all the processes (the value itself without distributed training)
+def all_reduce_mean(value):
+	if not dist.is_initialized():
+		return value
+	tensor = torch.tensor(value, dtype=torch.float64)
+	dist.all_reduce(tensor)
+	return tensor.item() / dist.get_world_size()
+
+
+
+# Sum of a list of values over all the processes
+def all_reduce_sum(values):
+	if not dist.is_initialized():
+		return values
+	tensor = torch.tensor(values, dtype=torch.float64)
+	dist.all_reduce(tensor)
+	return tensor.tolist()
+
+
+
+# Different shuffling on every epoch with a DistributedSampler, a LengthBucketBatchSampler or a TokenShardDataset
+def set_sampler_epoch(data_loader, epoch):
+	for epoch_source in (data_loader.sampler, data_loader.batch_sampler, data_loader.dataset):
+		if hasattr(epoch_source, "set_epoch"):
+			epoch_source.set_epoch(epoch)
+
+
+
+def no_sync_context(model, sync):
+	if sync or not isinstance(model, nn.parallel.DistributedDataParallel):
+		return nullcontext()
+	return model.no_sync()
+
+
+
+
+
 def get_device():
 	# Apple silicon
 	if torch.cuda.is_available():
@@ -413,6 +1183,234 @@ def get_device():
 
 
 
+"""
+  fused_checkpoint
+    Path of a copy of the checkpoint with the query/key/value projections fused (W_qkv), written once
+    next to a checkpoint with the split layout (and again when the checkpoint changes). Loading the
+    fused copy memory-mapped keeps the fused weights shared through the page cache, instead of
+    concatenating them in the private memory of every worker. Returns checkpoint_path when it is
+    already fused or the copy can not be written.
+"""
+def fused_checkpoint(checkpoint_path):
+	root, ext = os.path.splitext(checkpoint_path)
+	fused_path = f"{root}-fused{ext}"
+	if os.path.exists(fused_path) and os.path.getmtime(fused_path) >= os.path.getmtime(checkpoint_path):
+		return fused_path
+	state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=True, mmap=True)
+	prefixes = [key[:-len("W_query.weight")] for key in state_dict if key.endswith("W_query.weight")]
+	if not prefixes:
+		return checkpoint_path
+	for prefix in prefixes:
+		for param in ("weight", "bias"):
+			split_keys = [f"{prefix}{name}.{param}" for name in ("W_query", "W_key", "W_value")]
+			if all(key in state_dict for key in split_keys):
+				state_dict[f"{prefix}W_qkv.{param}"] = torch.cat([state_dict.pop(key) for key in split_keys], dim=0)
+	try:
+		atomic_write(fused_path, lambda file: torch.save(state_dict, file))
+	except OSError:
+		return checkpoint_path
+	return fused_path
+
+
+
+"""
+  load_model
+    Builds the model on the meta device (no memory allocated and no random initialization) and assigns
+    the weights of the checkpoint memory-mapped from disk, so the pages are shared between the worker
+    processes through the page cache. out_features replaces the output head (e.g. 2 for the classifier).
+    With cfg["fused_qkv"] the fused copy of the checkpoint is loaded (see fused_checkpoint).
+"""
+def load_model(cfg, checkpoint_path, device, out_features=None):
+	if cfg.get("fused_qkv", False):
+		checkpoint_path = fused_checkpoint(checkpoint_path)
+	with torch.device("meta"):
+		model = GPTModel(cfg)
+		if out_features is not None:
+			model.out_head = nn.Linear(cfg["emb_dim"], out_features)
+	state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=True, mmap=True)
+	model.load_state_dict(state_dict, assign=True)
+	model.to(device)
+	model.eval()
+	return model
+
+
+
+
+"""
+  quantize_model
+    Dynamic int8 quantization of the linear layers (attention, feed forward and output head): the
+    weights are stored in int8 and the activations are quantized on the fly. CPU inference only.
+"""
+def quantize_model(model):
+	model.eval()
+	return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+
+"""
+  compile_model
+    torch.compile of a model for inference. With cache_dir the compiled graphs (inductor FX graph cache)
+    are stored on disk and reused by the next processes instead of compiling again. dynamic=False compiles
+    one graph per input shape (e.g. per bucket length), dynamic=True a single graph for the varying lengths
+    of generation. The model is compiled in place (nn.Module.compile), so it stays the same module for the
+    code switching its weights (e.g. set_adapter).
+"""
+def compile_model(model, cache_dir=None, dynamic=None, mode=None):
+	import torch._inductor.config
+	if cache_dir is not None:
+		os.makedirs(cache_dir, exist_ok=True)
+		os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+		torch._inductor.config.fx_graph_cache = True
+	model.eval()
+	model.compile(dynamic=dynamic, mode=mode)
+	return model
+
+
+
+# Export wrapper of the kv cache decoder graph: past keys/values in, present keys/values out
+class OnnxDecoder(nn.Module):
+	def __init__(self, model):
+		super().__init__()
+		self.model = model
+
+	def forward(self, input_ids, position_ids, attention_mask, *past):
+		n_layers = len(past) // 2
+		kv_cache = KVCache(n_layers)
+		kv_cache.keys, kv_cache.values = list(past[:n_layers]), list(past[n_layers:])
+		logits = self.model(input_ids, kv_cache=kv_cache, position_ids=position_ids, attn_mask=attention_mask[:, None, None, :], positions=-1)
+		return (logits, *kv_cache.keys, *kv_cache.values)
+
+
+# Export wrapper of the graph without cache (LM or classifier head)
+class OnnxHead(nn.Module):
+	def __init__(self, model):
+		super().__init__()
+		self.model = model
+
+	def forward(self, input_ids):
+		return self.model(input_ids, positions=-1)
+
+
+
+"""
+  export_onnx
+    Exports a (not quantized) model to ONNX, the graphs return the logits of the last position:
+      use_cache=False: input_ids -> logits, for the LM head or the classifier head.
+      use_cache=True: input_ids, position_ids, attention_mask (batch_size, num_keys) and the past keys/values
+        of every layer -> logits and the present keys/values. The same graph runs the prefill (empty past)
+        and every decoding step.
+"""
+def export_onnx(model, file_path, use_cache=False, opset_version=17):
+	model.eval()
+	input_ids = torch.zeros((1, 2), dtype=torch.long)
+	if not use_cache:
+		torch.onnx.export(
+			OnnxHead(model), (input_ids,), file_path, opset_version=opset_version,
+			input_names=["input_ids"], output_names=["logits"],
+			dynamic_axes={"input_ids": {0: "batch_size", 1: "num_tokens"}, "logits": {0: "batch_size"}}
+		)
+		return
+
+	att = model.trf_blocks[0].att
+	n_layers = len(model.trf_blocks)
+	num_past = 3
+	position_ids = torch.arange(num_past, num_past + 2).unsqueeze(0)
+	attention_mask = torch.ones((1, num_past + 2), dtype=torch.bool)
+	past = [torch.zeros((1, att.num_heads, num_past, att.head_dim)) for _ in range(2 * n_layers)]
+	past_names = [f"past_key_{i}" for i in range(n_layers)] + [f"past_value_{i}" for i in range(n_layers)]
+	present_names = [f"present_key_{i}" for i in range(n_layers)] + [f"present_value_{i}" for i in range(n_layers)]
+
+	dynamic_axes = {
+		"input_ids": {0: "batch_size", 1: "num_tokens"},
+		"position_ids": {0: "batch_size", 1: "num_tokens"},
+		"attention_mask": {0: "batch_size", 1: "num_keys"},
+		"logits": {0: "batch_size"}
+	}
+	dynamic_axes.update({name: {0: "batch_size", 2: "num_past"} for name in past_names})
+	dynamic_axes.update({name: {0: "batch_size", 2: "num_keys"} for name in present_names})
+	torch.onnx.export(
+		OnnxDecoder(model), (input_ids, position_ids, attention_mask, *past), file_path, opset_version=opset_version,
+		input_names=["input_ids", "position_ids", "attention_mask", *past_names],
+		output_names=["logits", *present_names], dynamic_axes=dynamic_axes
+	)
+
+
+
+"""
+  OnnxModel
+    Runs an exported graph (see export_onnx) with ONNX Runtime on the CPU, with the calling convention of
+    GPTModel for the inference code (classify_review, classify_batch, the text generation functions):
+    only the logits of the last position (positions=-1) and, for the kv cache graphs, padding masks of
+    shape (batch_size, 1, 1, num_keys).
+"""
+class OnnxModel:
+	def __init__(self, file_path, context_length, num_threads=None):
+		import onnxruntime as ort
+		options = ort.SessionOptions()
+		options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+		if num_threads is not None:
+			options.intra_op_num_threads = num_threads
+		self.session = ort.InferenceSession(file_path, options, providers=["CPUExecutionProvider"])
+		self.context_length = context_length
+
+		# Number of layers of the kv cache graph (0 for the graph without cache)
+		past_keys = [graph_input for graph_input in self.session.get_inputs() if graph_input.name.startswith("past_key_")]
+		self.n_layers = len(past_keys)
+		if self.n_layers > 0:
+			_, self.num_heads, _, self.head_dim = past_keys[0].shape
+
+	def eval(self):
+		return self
+
+	def new_kv_cache(self):
+		if self.n_layers == 0:
+			raise ValueError("The ONNX graph was exported without kv cache")
+		return KVCache(self.n_layers)
+
+	def __call__(self, in_idx, kv_cache=None, pos_offset=None, position_ids=None, attn_mask=None, positions=None, return_hidden=False):
+		if positions != -1 or return_hidden:
+			raise ValueError("The ONNX graphs only return the logits of the last position (positions=-1)")
+		inputs = {"input_ids": in_idx.cpu().numpy()}
+
+		if self.n_layers > 0:
+			batch_size, seq_len = in_idx.shape
+			num_past = 0 if kv_cache is None else len(kv_cache)
+			if position_ids is None:
+				if pos_offset is None:
+					pos_offset = num_past
+				position_ids = torch.arange(pos_offset, pos_offset + seq_len)
+			if attn_mask is None:
+				attn_mask = torch.ones((batch_size, num_past + seq_len), dtype=torch.bool)
+			inputs["position_ids"] = position_ids.expand(batch_size, seq_len).cpu().numpy()
+			inputs["attention_mask"] = attn_mask.reshape(batch_size, -1).cpu().numpy()
+			empty = np.zeros((batch_size, self.num_heads, 0, self.head_dim), dtype=np.float32)
+			for layer_idx in range(self.n_layers):
+				cached = kv_cache is not None and kv_cache.keys[layer_idx] is not None
+				inputs[f"past_key_{layer_idx}"] = kv_cache.keys[layer_idx].numpy() if cached else empty
+				inputs[f"past_value_{layer_idx}"] = kv_cache.values[layer_idx].numpy() if cached else empty
+		elif kv_cache is not None:
+			raise ValueError("The ONNX graph was exported without kv cache")
+
+		outputs = self.session.run(None, inputs)
+		if kv_cache is not None:
+			kv_cache.keys = [torch.from_numpy(keys) for keys in outputs[1:1 + self.n_layers]]
+			kv_cache.values = [torch.from_numpy(values) for values in outputs[1 + self.n_layers:]]
+		return torch.from_numpy(outputs[0]).to(in_idx.device)
+
+
+
+# Loads a checkpoint saved from a quantized model (see quantize_model)
+def load_quantized_model(cfg, checkpoint_path, out_features=None):
+	model = GPTModel(cfg)
+	if out_features is not None:
+		model.out_head = nn.Linear(cfg["emb_dim"], out_features)
+	model = quantize_model(model)
+	model.load_state_dict(torch.load(checkpoint_path, map_location="cpu", weights_only=True))
+	return model
+
+
+
+
 """
   Load weights of a already pre-trained model into the current architecture 
   of this GPT library 
@@ -422,23 +1420,32 @@ def load_weights_into_gpt(gpt, params):
     gpt.tok_emb.weight = assign(gpt.tok_emb.weight, params['wte'])
 
     for b in range(len(params["blocks"])):   
-        q_w, k_w, v_w = np.split(                           
-            (params["blocks"][b]["attn"]["c_attn"])["w"], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.weight = assign(
-            gpt.trf_blocks[b].att.W_query.weight, q_w.T)
-        gpt.trf_blocks[b].att.W_key.weight = assign(
-            gpt.trf_blocks[b].att.W_key.weight, k_w.T)
-        gpt.trf_blocks[b].att.W_value.weight = assign(
-            gpt.trf_blocks[b].att.W_value.weight, v_w.T)
-
-        q_b, k_b, v_b = np.split(
-            (params["blocks"][b]["attn"]["c_attn"])["b"], 3, axis=-1)
-        gpt.trf_blocks[b].att.W_query.bias = assign(
-            gpt.trf_blocks[b].att.W_query.bias, q_b)
-        gpt.trf_blocks[b].att.W_key.bias = assign(
-            gpt.trf_blocks[b].att.W_key.bias, k_b)
-        gpt.trf_blocks[b].att.W_value.bias = assign(
-            gpt.trf_blocks[b].att.W_value.bias, v_b)
+        if gpt.trf_blocks[b].att.fused_qkv:
+            # c_attn already has the fused (query, key, value) layout
+            gpt.trf_blocks[b].att.W_qkv.weight = assign(
+                gpt.trf_blocks[b].att.W_qkv.weight, 
+                params["blocks"][b]["attn"]["c_attn"]["w"].T)
+            gpt.trf_blocks[b].att.W_qkv.bias = assign(
+                gpt.trf_blocks[b].att.W_qkv.bias, 
+                params["blocks"][b]["attn"]["c_attn"]["b"])
+        else:
+            q_w, k_w, v_w = np.split(                           
+                (params["blocks"][b]["attn"]["c_attn"])["w"], 3, axis=-1)
+            gpt.trf_blocks[b].att.W_query.weight = assign(
+                gpt.trf_blocks[b].att.W_query.weight, q_w.T)
+            gpt.trf_blocks[b].att.W_key.weight = assign(
+                gpt.trf_blocks[b].att.W_key.weight, k_w.T)
+            gpt.trf_blocks[b].att.W_value.weight = assign(
+                gpt.trf_blocks[b].att.W_value.weight, v_w.T)
+
+            q_b, k_b, v_b = np.split(
+                (params["blocks"][b]["attn"]["c_attn"])["b"], 3, axis=-1)
+            gpt.trf_blocks[b].att.W_query.bias = assign(
+                gpt.trf_blocks[b].att.W_query.bias, q_b)
+            gpt.trf_blocks[b].att.W_key.bias = assign(
+                gpt.trf_blocks[b].att.W_key.bias, k_b)
+            gpt.trf_blocks[b].att.W_value.bias = assign(
+                gpt.trf_blocks[b].att.W_value.bias, v_b)
 
         gpt.trf_blocks[b].att.out_proj.weight = assign(
             gpt.trf_blocks[b].att.out_proj.weight, 
@@ -489,6 +1496,239 @@ def assign(left, right):
 
 
 
+# ================================================== Low-rank adapters ==================================================
+"""
+  LoRALinear
+    Linear layer shared by several low-rank adapters, computes linear(x) + scaling * (x @ A @ B)
+    with the A, B of the active adapter. Without an active adapter it is the plain base layer.
+"""
+class LoRALinear(nn.Module):
+	def __init__(self, linear):
+		super().__init__()
+		self.linear = linear
+		self.lora_A = nn.ParameterDict()
+		self.lora_B = nn.ParameterDict()
+		self.scaling = {}
+		self.active_adapter = None
+
+	def add_adapter(self, name, rank, alpha, A=None, B=None):
+		if A is None:
+			# B starts at zero, so a new adapter starts as the base layer
+			A = torch.empty(self.linear.in_features, rank)
+			nn.init.kaiming_uniform_(A, a=5**0.5)
+			B = torch.zeros(rank, self.linear.out_features)
+		weight = self.linear.weight
+		self.lora_A[name] = nn.Parameter(A.to(device=weight.device, dtype=weight.dtype))
+		self.lora_B[name] = nn.Parameter(B.to(device=weight.device, dtype=weight.dtype))
+		self.scaling[name] = alpha / rank
+
+	def forward(self, x):
+		out = self.linear(x)
+		if self.active_adapter is not None:
+			name = self.active_adapter
+			out = out + self.scaling[name] * (x @ self.lora_A[name] @ self.lora_B[name])
+		return out
+
+
+
+"""
+  add_lora_layers
+    Wraps every linear layer of the model (attention, feed forward and output head) so it can
+    take adapters. The base weights are frozen and shared by all the adapters.
+"""
+def add_lora_layers(model):
+	for module in list(model.modules()):
+		for child_name, child in list(module.named_children()):
+			if isinstance(child, nn.Linear):
+				setattr(module, child_name, LoRALinear(child))
+	for param in model.parameters():
+		param.requires_grad = False
+	# Plain dict, so the modules kept here are not registered as part of the model
+	model.lora_state = {
+		"adapters": {},
+		"base_params": {},
+		"base_out_head": model.out_head,
+		"lock": threading.Lock()
+	}
+	return model
+
+
+
+# Name of a parameter of the base model inside the model with the LoRA layers
+def lora_param_name(model, param_name):
+	module_name, attr = param_name.rsplit(".", 1)
+	if isinstance(model.get_submodule(module_name), LoRALinear):
+		module_name += ".linear"
+	return f"{module_name}.{attr}"
+
+
+
+def set_param(model, param_name, param):
+	module_name, attr = param_name.rsplit(".", 1)
+	setattr(model.get_submodule(module_name), attr, param)
+
+
+
+"""
+  add_adapter
+    Adds a new trainable adapter of the given rank to every LoRA layer (for fine-tuning with LoRA).
+"""
+def add_adapter(model, name, rank=16, alpha=16):
+	for module in model.modules():
+		if isinstance(module, LoRALinear):
+			module.add_adapter(name, rank, alpha)
+	model.lora_state["adapters"][name] = {"params": {}, "out_head": None}
+
+
+
+"""
+  extract_adapter
+    Adapter approximating a full fine-tune of the base model: truncated SVD of the difference of every
+    linear weight, the small tensors that changed (biases, layer norms, positions) are kept as they are and
+    an output head of another shape (e.g. the classifier) is stored whole. Both models must be plain 
+    GPTModels of the same configuration. The difference of the token embedding is not kept.
+"""
+def extract_adapter(base_model, finetuned_model, rank=16):
+	base_state_dict = base_model.state_dict()
+	finetuned_state_dict = finetuned_model.state_dict()
+	linear_names = {name for name, module in base_model.named_modules() if isinstance(module, nn.Linear)}
+	head_replaced = finetuned_state_dict["out_head.weight"].shape != base_state_dict["out_head.weight"].shape
+
+	adapter = {"rank": rank, "alpha": rank, "lora": {}, "params": {}, "out_head": None}
+	if head_replaced:
+		adapter["out_head"] = {name: tensor for name, tensor in finetuned_model.out_head.state_dict().items()}
+
+	for name, tensor in finetuned_state_dict.items():
+		if (head_replaced and name.startswith("out_head.")) or name == "tok_emb.weight":
+			continue
+		base_tensor = base_state_dict[name]
+		if torch.equal(base_tensor, tensor):
+			continue
+		module_name, attr = name.rsplit(".", 1)
+		if module_name in linear_names and attr == "weight":
+			# x @ (W + delta).T = x @ W.T + x @ A @ B, with delta.T ~ U S V
+			U, S, V = torch.linalg.svd((tensor - base_tensor).T.float(), full_matrices=False)
+			adapter["lora"][module_name] = (U[:, :rank] * S[:rank], V[:rank].clone())
+		else:
+			adapter["params"][name] = tensor
+	return adapter
+
+
+
+"""
+  fuse_qkv_adapter
+    Converts the query/key/value parts of an adapter extracted from models with split W_query, W_key and
+    W_value layers to the W_qkv layers of a fused_qkv model: the A matrices side by side and the B matrices
+    block diagonal (x @ [A_q A_k A_v] @ diag(B_q, B_k, B_v) = [x @ A_q @ B_q, ...]), the changed biases
+    are concatenated with the base biases of the unchanged ones.
+"""
+def fuse_qkv_adapter(model, adapter):
+	lora, params = dict(adapter["lora"]), dict(adapter["params"])
+	for block_idx, block in enumerate(model.trf_blocks):
+		if not block.att.fused_qkv:
+			continue
+		prefix = f"trf_blocks.{block_idx}.att."
+		names = [prefix + layer_name for layer_name in ("W_query", "W_key", "W_value")]
+		qkv = block.att.W_qkv.linear if isinstance(block.att.W_qkv, LoRALinear) else block.att.W_qkv
+		d_out = qkv.out_features // 3
+
+		factors = [lora.pop(layer_name, None) for layer_name in names]
+		if any(factor is not None for factor in factors):
+			rank = next(A.shape[1] for A, _ in filter(None, factors))
+			A = torch.cat([factor[0] if factor else torch.zeros(qkv.in_features, rank) for factor in factors], dim=1)
+			B = torch.block_diag(*[factor[1] if factor else torch.zeros(rank, d_out) for factor in factors])
+			lora[prefix + "W_qkv"] = (A, B)
+
+		bias_names = [layer_name + ".bias" for layer_name in names]
+		if any(bias_name in params for bias_name in bias_names):
+			base_name = lora_param_name(model, prefix + "W_qkv.bias")
+			base_bias = model.lora_state["base_params"].get(base_name, model.get_parameter(base_name))
+			base_biases = base_bias.detach().cpu().split(d_out)
+			params[prefix + "W_qkv.bias"] = torch.cat([
+				params.pop(bias_name, base) for bias_name, base in zip(bias_names, base_biases)
+			])
+	return {**adapter, "lora": lora, "params": params}
+
+
+
+"""
+  load_adapter
+    Loads an adapter (see extract_adapter) into a model with LoRA layers under the given name.
+"""
+def load_adapter(model, name, adapter):
+	adapter = fuse_qkv_adapter(model, adapter)
+	for module_name, (A, B) in adapter["lora"].items():
+		model.get_submodule(module_name).add_adapter(name, adapter["rank"], adapter["alpha"], A, B)
+
+	device = next(model.parameters()).device
+	params = {}
+	for param_name, tensor in adapter["params"].items():
+		param_name = lora_param_name(model, param_name)
+		model.lora_state["base_params"].setdefault(param_name, model.get_parameter(param_name))
+		params[param_name] = nn.Parameter(tensor.to(device), requires_grad=False)
+
+	out_head = None
+	if adapter["out_head"] is not None:
+		out_features, in_features = adapter["out_head"]["weight"].shape
+		out_head = nn.Linear(in_features, out_features, bias="bias" in adapter["out_head"])
+		out_head.load_state_dict(adapter["out_head"])
+		out_head.to(device)
+		out_head.eval()
+	model.lora_state["adapters"][name] = {"params": params, "out_head": out_head}
+
+
+
+"""
+  set_adapter
+    Activates an adapter of the model (None for the base model), switching only references to
+    the weights of the adapter, no weights are copied.
+"""
+def set_adapter(model, name=None):
+	state = model.lora_state
+	adapter = state["adapters"].get(name, {"params": {}, "out_head": None})
+	model.out_head = adapter["out_head"] if adapter["out_head"] is not None else state["base_out_head"]
+	for param_name, base_param in state["base_params"].items():
+		set_param(model, param_name, adapter["params"].get(param_name, base_param))
+	for module in model.modules():
+		if isinstance(module, LoRALinear):
+			module.active_adapter = name if name in module.lora_A else None
+
+
+
+"""
+  use_adapter
+    Context manager activating an adapter, the lock keeps other threads from switching the 
+    adapter of the shared model while it is in use. Every other adapter waits for the whole block,
+    use AdapterModel to only hold the lock during each forward pass.
+"""
+@contextmanager
+def use_adapter(model, name):
+	with model.lora_state["lock"]:
+		set_adapter(model, name)
+		yield model
+
+
+
+"""
+  AdapterModel
+    The shared model with an adapter activated on every forward pass. The lock is only held during each
+    forward pass, so a long generation with one adapter does not block the requests of the others
+    (e.g. a classification runs between two decoding steps of the assistant).
+"""
+class AdapterModel:
+	def __init__(self, model, name):
+		self.model = model
+		self.name = name
+
+	def __call__(self, *args, **kwargs):
+		with use_adapter(self.model, self.name) as model:
+			return model(*args, **kwargs)
+
+	def __getattr__(self, attr):
+		return getattr(self.model, attr)
+
+
+
 def plot_values(epochs_seen, examples_seen, trainin_values, val_values, label="loss"):
 	fig, ax1 = plt.subplots(figsize=(5, 3))
 	
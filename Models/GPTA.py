@@ -1,8 +1,11 @@
 import os
+import GPT
 import json
 import torch
+import random
 import urllib
 from torch.utils.data import Dataset
+from torch.utils.data import Sampler
 
 
 # Download the dataset
@@ -38,62 +41,164 @@ def format_input(entry):
 
 
 class InstructionDataset(Dataset):
-  def __init__(self, data, tokenizer):
+  def __init__(self, data, tokenizer, cache_dir=None):
     self.data = data
 
-    # Pre-tokenize texts
-    self.encoded_texts = []
+    # Pre-tokenize texts (in parallel, or loaded from the token cache)
+    full_texts = []
     for entry in data:
       instruction_plus_input = format_input(entry)
       response_text = f"\n\n### Response:\n{entry['output']}"
-      full_text = instruction_plus_input + response_text
-      self.encoded_texts.append(
-          tokenizer.encode(full_text)
-      )
+      full_texts.append(instruction_plus_input + response_text)
+    self.encoded_texts = GPT.encode_texts(full_texts, tokenizer, cache_dir)
 
   def __getitem__(self, index):
     return self.encoded_texts[index]
 
   def __len__(self):
     return len(self.data)
-  
 
+  # Number of tokens of every example, for the LengthBucketBatchSampler
+  def lengths(self):
+    return [len(encoded_text) for encoded_text in self.encoded_texts]
+
+
+
+
+"""
+  PackedInstructionDataset
+    Packs several instruction examples into rows of context_length tokens (first-fit decreasing), so almost
+    no compute goes to padding. The target of the last token of every example is <|endoftext|>, the positions
+    of every example start at 0 and GPT.calc_loss_batch builds from them a block-diagonal mask, so the 
+    examples do not attend to each other. Items are (inputs, targets, position_ids).
+"""
+class PackedInstructionDataset(Dataset):
+  def __init__(self, dataset, context_length, pad_token_id=50256, ignore_index=-100):
+    examples = [encoded_text[:context_length] for encoded_text in dataset.encoded_texts if encoded_text]
+
+    # Place every example (longest first) in the first row with space for it
+    rows, free_space = [], []
+    for index in sorted(range(len(examples)), key=lambda index: len(examples[index]), reverse=True):
+      length = len(examples[index])
+      for row, space in enumerate(free_space):
+        if space >= length:
+          rows[row].append(index)
+          free_space[row] -= length
+          break
+      else:
+        rows.append([index])
+        free_space.append(context_length - length)
+
+    self.inputs = torch.full((len(rows), context_length), pad_token_id, dtype=torch.long)
+    self.targets = torch.full((len(rows), context_length), ignore_index, dtype=torch.long)
+    self.position_ids = torch.zeros((len(rows), context_length), dtype=torch.long)
+    for row, indices in enumerate(rows):
+      start = 0
+      for index in indices:
+        tokens = examples[index]
+        end = start + len(tokens)
+        self.inputs[row, start:end] = torch.tensor(tokens)
+        self.targets[row, start:end] = torch.tensor(tokens[1:] + [pad_token_id])
+        self.position_ids[row, start:end] = torch.arange(len(tokens))
+        start = end
+      # The padding at the end is a segment of its own
+      self.position_ids[row, start:] = torch.arange(context_length - start)
 
+  def __getitem__(self, index):
+    return self.inputs[index], self.targets[index], self.position_ids[index]
 
-def input_preparation_txt( batch, device="mps", pad_token_id=50256, ignore_index=-100, allowed_max_length=None):
-    batch_max_length = max(len(item)+1 for item in batch)
-
-    # Pad and prepare inputs and targets
-    inputs_lst, targets_lst = [], []
-
-    for item in batch:
-        new_item = item.copy()
-        # Add an <|endoftext|> token
-        new_item += [pad_token_id]
-        # Pad sequences to max_length
-        padded = (
-            new_item + [pad_token_id] *
-            (batch_max_length - len(new_item))
+  def __len__(self):
+    return len(self.inputs)
+
+
+
+
+"""
+  LengthBucketBatchSampler
+    Batches of examples of similar length, so little compute goes to padding. The shuffled examples are sorted
+    by length inside pools of pool_size examples, cut into batches and the order of the batches is shuffled.
+    Batches have batch_size examples, or with max_tokens as many examples as fit in max_tokens padded tokens.
+      DataLoader(dataset, batch_sampler=LengthBucketBatchSampler(dataset.lengths(), max_tokens=4096), collate_fn=...)
+"""
+class LengthBucketBatchSampler(Sampler):
+  def __init__(self, lengths, batch_size=None, max_tokens=None, pool_size=1000, shuffle=True, drop_last=False, seed=123):
+    assert (batch_size is None) != (max_tokens is None), "Use either batch_size or max_tokens"
+    self.lengths = lengths
+    self.batch_size = batch_size
+    self.max_tokens = max_tokens
+    self.pool_size = pool_size
+    self.shuffle = shuffle
+    self.drop_last = drop_last
+    self.seed = seed
+    self.epoch = 0
+
+  # Different batches on every epoch
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def create_batches(self):
+    generator = random.Random(self.seed + self.epoch)
+    indices = list(range(len(self.lengths)))
+    if self.shuffle:
+      generator.shuffle(indices)
+
+    batches = []
+    for start in range(0, len(indices), self.pool_size):
+      pool = sorted(indices[start:start + self.pool_size], key=lambda index: self.lengths[index])
+      batch, batch_max_length = [], 0
+      for index in pool:
+        # Padded size of the batch with the new example
+        new_max_length = max(batch_max_length, self.lengths[index])
+        full = (
+          len(batch) == self.batch_size if self.max_tokens is None
+          else batch and (len(batch) + 1) * new_max_length > self.max_tokens
         )
-        inputs = torch.tensor(padded[:-1])  # Truncate the last token for inputs
-        targets = torch.tensor(padded[1:])  # Shift +1 to the right for targets
+        if full:
+          batches.append(batch)
+          batch, new_max_length = [], self.lengths[index]
+        batch.append(index)
+        batch_max_length = new_max_length
+      if batch and not (self.drop_last and self.max_tokens is None and len(batch) < self.batch_size):
+        batches.append(batch)
 
-        # Add the ignore_index token
-        mask = targets == pad_token_id
-        indices = torch.nonzero(mask).squeeze()
-        if indices.numel() > 1:
-            targets[indices[1:]] = ignore_index
+    if self.shuffle:
+      generator.shuffle(batches)
+    return batches
 
-        # truncate to maximum sequence length
-        if allowed_max_length is not None:
-            inputs = inputs[:allowed_max_length]
-            targets = targets[:allowed_max_length]
+  def __iter__(self):
+    return iter(self.create_batches())
 
-        inputs_lst.append(inputs)
-        targets_lst.append(targets)
+  def __len__(self):
+    return len(self.create_batches())
+  
 
-    # Convert list of inputs and targets to tensors and transfer to target device
-    inputs_tensor = torch.stack(inputs_lst).to(device)
-    targets_tensor = torch.stack(targets_lst).to(device)
 
-    return inputs_tensor, targets_tensor
\ No newline at end of file
+
+def input_preparation_txt( batch, device="mps", pad_token_id=50256, ignore_index=-100, allowed_max_length=None):
+    # Every item gets an <|endoftext|> token and is padded to the longest item of the batch
+    lengths = torch.tensor([len(item) for item in batch])
+    batch_max_length = int(lengths.max()) + 1
+
+    # Preallocated padded matrix, the tokens of all the items are written in a single assignment
+    padded = torch.full((len(batch), batch_max_length), pad_token_id, dtype=torch.long)
+    token_mask = torch.arange(batch_max_length) < lengths.unsqueeze(1)
+    padded[token_mask] = torch.tensor([token for item in batch for token in item], dtype=torch.long)
+
+    inputs = padded[:, :-1]  # Truncate the last token for inputs
+    targets = padded[:, 1:].clone()  # Shift +1 to the right for targets
+
+    # Add the ignore_index token, except on the first padding token (the <|endoftext|>) of each item
+    pad_mask = targets == pad_token_id
+    first_pad = pad_mask & (pad_mask.cumsum(dim=1) == 1)
+    targets[pad_mask & ~first_pad] = ignore_index
+
+    # truncate to maximum sequence length
+    if allowed_max_length is not None:
+        inputs = inputs[:, :allowed_max_length]
+        targets = targets[:, :allowed_max_length]
+
+    # Transfer to target device, through pinned memory for an asynchronous copy to the GPU
+    inputs, targets = inputs.contiguous(), targets.contiguous()
+    if torch.device(device).type == "cuda":
+        return inputs.pin_memory().to(device, non_blocking=True), targets.pin_memory().to(device, non_blocking=True)
+    return inputs.to(device), targets.to(device)
@@ -1,4 +1,5 @@
 import os
+import GPT
 import torch
 import zipfile
 import pandas as pd
@@ -48,57 +49,67 @@ def random_split(df, train_frac, validation_frac):
 
 
 
+"""
+  SpamDataset
+    Tokens (padded to max_length), lengths and labels of the messages in preallocated tensors.
+    dynamic_padding: items are (tokens, label, length) and collate pads every batch only up to its
+    longest message, the loss/accuracy then read the logits of the last real token of every message
+    instead of the last padded one. Use it with DataLoader(..., collate_fn=dataset.collate).
+"""
 class SpamDataset(Dataset):
-    def __init__(self, csv_file, tokenizer, max_length=None, pad_token_id=50256):
-        self.data = pd.read_csv(csv_file)
+    def __init__(self, csv_file, tokenizer, max_length=None, pad_token_id=50256, cache_dir=None, dynamic_padding=False):
+        data = pd.read_csv(csv_file)
+        self.dynamic_padding = dynamic_padding
 
-        # Pre-tokenize texts
-        self.encoded_texts = [
-            tokenizer.encode(text) for text in self.data["Text"]
-        ]
+        # Pre-tokenize texts (in parallel, or loaded from the token cache)
+        encoded_texts = GPT.encode_texts(data["Text"], tokenizer, cache_dir)
 
         if max_length is None:
-            self.max_length = self._longest_encoded_length()
+            self.max_length = max((len(encoded_text) for encoded_text in encoded_texts), default=0)
         else:
             self.max_length = max_length
-            # Truncate sequences if they are longer than max_length
-            self.encoded_texts = [
-                encoded_text[:self.max_length]
-                for encoded_text in self.encoded_texts
-            ]
-
-        # Pad sequences to the longest sequence
-        self.encoded_texts = [
-            encoded_text + [pad_token_id] * (self.max_length - len(encoded_text))
-            for encoded_text in self.encoded_texts
-        ]
+
+        # Truncate sequences if they are longer than max_length and pad them to it
+        self.tokens = torch.full((len(encoded_texts), self.max_length), pad_token_id, dtype=torch.long)
+        self.lengths = torch.zeros(len(encoded_texts), dtype=torch.long)
+        for index, encoded_text in enumerate(encoded_texts):
+            encoded_text = encoded_text[:self.max_length]
+            self.tokens[index, :len(encoded_text)] = torch.tensor(encoded_text, dtype=torch.long)
+            self.lengths[index] = len(encoded_text)
+        self.labels = torch.tensor(data["Label"].to_numpy(), dtype=torch.long)
 
     def __getitem__(self, index):
-        encoded = self.encoded_texts[index]
-        label = self.data.iloc[index]["Label"]
-        return (
-            torch.tensor(encoded, dtype=torch.long),
-            torch.tensor(label, dtype=torch.long)
-        )
+        if self.dynamic_padding:
+            return self.tokens[index], self.labels[index], self.lengths[index]
+        return self.tokens[index], self.labels[index]
 
     def __len__(self):
-        return len(self.data)
+        return len(self.labels)
+
+    # Batch padded up to its longest message
+    def collate(self, batch):
+        tokens, labels, lengths = (torch.stack(values) for values in zip(*batch))
+        return tokens[:, :max(lengths.max().item(), 1)], labels, lengths
+
 
-    def _longest_encoded_length(self):
-        max_length = 0
-        for encoded_text in self.encoded_texts:
-            encoded_length = len(encoded_text)
-            if encoded_length > max_length:
-                max_length = encoded_length
-        return max_length
 
 
+# Position of the last token of every text: the last position, or the last real token when the lengths are known
+def last_token_positions(lengths=None):
+    if lengths is None:
+        return -1
+    return (lengths - 1).clamp(min=0)
 
 
-def calc_loss_batch(input_batch, target_batch, model, device):
+
+# lengths: lengths of the messages of dynamically padded batches (see SpamDataset)
+def calc_loss_batch(input_batch, target_batch, model, device, precision=None, lengths=None):
     input_batch, target_batch = input_batch.to(device), target_batch.to(device)
-    logits = model(input_batch)[:, -1, :]  # Logits of last output token, the one containing all the information/attention of the text
-    loss = torch.nn.functional.cross_entropy(logits, target_batch)
+    if lengths is not None:
+        lengths = lengths.to(device)
+    with GPT.autocast_context(device, precision):
+        logits = model(input_batch, positions=last_token_positions(lengths))[:, -1, :]  # Logits of last output token, the one containing all the information/attention of the text
+    loss = torch.nn.functional.cross_entropy(logits.float(), target_batch)
     return loss
 
 
@@ -111,18 +122,21 @@ def calc_accuracy_loader(data_loader, model, device, num_batches=None):
         num_batches = len(data_loader)
     else:
         num_batches = min(num_batches, len(data_loader))
-    for i, (input_batch, target_batch) in enumerate(data_loader):
+    for i, (input_batch, target_batch, *lengths) in enumerate(data_loader):
         if i < num_batches:
             input_batch, target_batch = input_batch.to(device), target_batch.to(device)
+            lengths = lengths[0].to(device) if lengths else None
 
             with torch.no_grad():
-                logits = model(input_batch)[:, -1, :]  # Logits of last output token
+                logits = model(input_batch, positions=last_token_positions(lengths))[:, -1, :]  # Logits of last output token
             predicted_labels = torch.argmax(logits, dim=-1)
 
             num_examples += predicted_labels.shape[0]
             correct_predictions += (predicted_labels == target_batch).sum().item()
         else:
             break
+    # On distributed training the predictions of all the processes are counted
+    correct_predictions, num_examples = GPT.all_reduce_sum([correct_predictions, num_examples])
     return correct_predictions / num_examples
 
 
@@ -135,11 +149,11 @@ def evaluate_model(model, train_loader, val_loader, device, eval_iter):
 		train_loss = calc_loss_loader(train_loader, model, device, num_batches=eval_iter)
 		val_loss = calc_loss_loader(val_loader, model, device, num_batches=eval_iter)
 	model.train()
-	return train_loss, val_loss
+	return GPT.all_reduce_mean(train_loss), GPT.all_reduce_mean(val_loss)
 
 
 
-def calc_loss_loader(data_loader, model, device, num_batches=None):
+def calc_loss_loader(data_loader, model, device, num_batches=None, precision=None):
     total_loss = 0.
     if len(data_loader) == 0:
         return float("nan")
@@ -149,29 +163,48 @@ def calc_loss_loader(data_loader, model, device, num_batches=None):
         # Reduce the number of batches to match the total number of batches in the data loader
         # if num_batches exceeds the number of batches in the data loader
         num_batches = min(num_batches, len(data_loader))
-    for i, (input_batch, target_batch) in enumerate(data_loader):
+    for i, (input_batch, target_batch, *lengths) in enumerate(data_loader):
         if i < num_batches:
-            loss = calc_loss_batch(input_batch, target_batch, model, device)
+            loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *lengths)
             total_loss += loss.item()
         else:
             break
     return total_loss / num_batches
 
 
-def train_classifier_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter):
+
+# Loss of the same batches in fp32 and in mixed precision, to check the precision does not change the results
+def check_loss_parity(model, data_loader, device, precision, num_batches=5):
+    model.eval()
+    with torch.no_grad():
+        loss = calc_loss_loader(data_loader, model, device, num_batches=num_batches)
+        mixed_loss = calc_loss_loader(data_loader, model, device, num_batches=num_batches, precision=precision)
+    model.train()
+    if GPT.is_main_process():
+        print(f"Loss parity: fp32 {loss:.4f} | {precision} {mixed_loss:.4f} | difference {abs(mixed_loss - loss):.4f}")
+    return loss, mixed_loss
+
+
+# precision: None (fp32), "bf16" or "fp16" mixed precision of the forward pass (fp16 with loss scaling)
+def train_classifier_simple(model, train_loader, val_loader, optimizer, device, num_epochs, eval_freq, eval_iter, precision=None):
     # Initialize lists to track losses and examples seen
     train_losses, val_losses, train_accs, val_accs = [], [], [], []
     examples_seen, global_step = 0, -1
+    scaler = torch.amp.GradScaler(device.type, enabled=precision == "fp16")
+    if precision is not None:
+        check_loss_parity(model, val_loader, device, precision, num_batches=eval_iter)
 
     # Main training loop
     for epoch in range(num_epochs):
         model.train()  # Set model to training mode
+        GPT.set_sampler_epoch(train_loader, epoch)
 
-        for input_batch, target_batch in train_loader:
+        for input_batch, target_batch, *lengths in train_loader:
             optimizer.zero_grad() # Reset loss gradients from previous batch iteration
-            loss = calc_loss_batch(input_batch, target_batch, model, device)
-            loss.backward() # Calculate loss gradients
-            optimizer.step() # Update model weights using loss gradients
+            loss = calc_loss_batch(input_batch, target_batch, model, device, precision, *lengths)
+            scaler.scale(loss).backward() # Calculate loss gradients
+            scaler.step(optimizer) # Update model weights using loss gradients
+            scaler.update()
             examples_seen += input_batch.shape[0] # New: track examples instead of tokens
             global_step += 1
 
@@ -181,14 +214,16 @@ def train_classifier_simple(model, train_loader, val_loader, optimizer, device,
                     model, train_loader, val_loader, device, eval_iter)
                 train_losses.append(train_loss)
                 val_losses.append(val_loss)
-                print(f"Ep {epoch+1} (Step {global_step:06d}): "
-                      f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
+                if GPT.is_main_process():
+                    print(f"Ep {epoch+1} (Step {global_step:06d}): "
+                          f"Train loss {train_loss:.3f}, Val loss {val_loss:.3f}")
 
         # Calculate accuracy after each epoch
         train_accuracy = calc_accuracy_loader(train_loader, model, device, num_batches=eval_iter)
         val_accuracy = calc_accuracy_loader(val_loader, model, device, num_batches=eval_iter)
-        print(f"Training accuracy: {train_accuracy*100:.2f}% | ", end="")
-        print(f"Validation accuracy: {val_accuracy*100:.2f}%")
+        if GPT.is_main_process():
+            print(f"Training accuracy: {train_accuracy*100:.2f}% | ", end="")
+            print(f"Validation accuracy: {val_accuracy*100:.2f}%")
         train_accs.append(train_accuracy)
         val_accs.append(val_accuracy)
 
@@ -197,14 +232,16 @@ def train_classifier_simple(model, train_loader, val_loader, optimizer, device,
 
 
 
-def classify_review(text, model, tokenizer, device, max_length=None, pad_token_id=50256):
+# last_real_token: read the logits of the last real token, not of the last padded one (see classify_batch)
+def classify_review(text, model, tokenizer, device, max_length=None, pad_token_id=50256, last_real_token=False):
     model.eval()
     # Prepare inputs to the model
     input_ids = tokenizer.encode(text)
-    supported_context_length = model.pos_emb.weight.shape[0]
+    supported_context_length = model.context_length
 
     # Truncate sequences if they too long
     input_ids = input_ids[:min(max_length, supported_context_length)]
+    lengths = torch.tensor([len(input_ids)], device=device) if last_real_token else None
 
     # Pad sequences to the longest sequence
     input_ids += [pad_token_id] * (max_length - len(input_ids))
@@ -212,6 +249,55 @@ def classify_review(text, model, tokenizer, device, max_length=None, pad_token_i
 
     # Model inference
     with torch.no_grad():
-        logits = model(input_tensor)[:, -1, :]  # Logits of the last output token
+        logits = model(input_tensor, positions=last_token_positions(lengths))[:, -1, :]  # Logits of the last output token
     predicted_label = torch.argmax(logits, dim=-1).item()
-    return "spam" if predicted_label == 1 else "not spam"
\ No newline at end of file
+    return "spam" if predicted_label == 1 else "not spam"
+
+
+
+"""
+  classify_batch
+    Classifies a list of texts. The texts are grouped by token length into buckets, every bucket is
+    padded only up to its size and processed with one forward pass per chunk of batch_size texts.
+    last_real_token: read the logits of the last real token of every text instead of the last (padded)
+    position, so the result does not depend on the bucket size. Needed to serve several buckets, for
+    classifiers trained that way (SpamDataset with dynamic_padding). Otherwise use a single bucket of
+    the padding length used in training.
+    Returns the labels and the class probabilities of every text, in the input order.
+"""
+def classify_batch(texts, model, tokenizer, device, bucket_sizes=(120,), batch_size=32, pad_token_id=50256, last_real_token=False):
+    model.eval()
+    supported_context_length = model.context_length
+    bucket_sizes = sorted(min(size, supported_context_length) for size in bucket_sizes)
+
+    # Truncate sequences if they too long
+    encoded_texts = [tokenizer.encode(text)[:bucket_sizes[-1]] for text in texts]
+
+    # Smallest bucket able to hold each text
+    buckets = {}
+    for index, input_ids in enumerate(encoded_texts):
+        size = next(size for size in bucket_sizes if len(input_ids) <= size)
+        buckets.setdefault(size, []).append(index)
+
+    labels, probabilities = [None] * len(texts), [None] * len(texts)
+    for size, indices in buckets.items():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+
+            # Pad the sequences to the bucket size
+            input_tensor = torch.full((len(chunk), size), pad_token_id, dtype=torch.long)
+            for row, index in enumerate(chunk):
+                input_tensor[row, :len(encoded_texts[index])] = torch.tensor(encoded_texts[index], dtype=torch.long)
+
+            lengths = torch.tensor([len(encoded_texts[index]) for index in chunk], device=device) if last_real_token else None
+
+            # Model inference
+            with torch.no_grad():
+                logits = model(input_tensor.to(device), positions=last_token_positions(lengths))[:, -1, :]  # Logits of the last output token
+            probas = torch.softmax(logits, dim=-1).tolist()
+            predicted_labels = torch.argmax(logits, dim=-1).tolist()
+
+            for row, index in enumerate(chunk):
+                labels[index] = "spam" if predicted_labels[row] == 1 else "not spam"
+                probabilities[index] = probas[row]
+    return labels, probabilities
@@ -0,0 +1,58 @@
+"""
+  Exports a checkpoint to ONNX for the ONNX Runtime backend of the API (GPT_BACKEND=onnx). The classifier
+  is exported without cache, the assistant as a kv cache decoder graph.
+
+    python export_onnx.py --checkpoint classifier.pth --output ../Models/classifier.onnx --out-features 2
+    python export_onnx.py --checkpoint Assistant.pth --output ../Models/Assistant.onnx --use-cache
+"""
+import time
+import torch
+import argparse
+import GPT
+
+
+# Model cunfiguration
+GPT_CONFIG_124M = {
+    "vocab_size": 50257,    # Vocabulary size
+    "context_length": 1024, # context 
+    "emb_dim": 768,         # Embedding dimension
+    "n_heads": 12,          # Number of attention heads
+    "n_layers": 12,         # Number of layers
+    "drop_rate": 0.1,       # Dropout rate
+    "qkv_bias": True,       # Query-key-value bias
+    "fused_qkv": True,      # Single query-key-value projection
+    "fused_ops": True       # Fused LayerNorm and GELU kernels
+}
+
+
+
+# Maximum difference between the logits of the model and of the exported graph on a sample input
+def check_export(model, file_path, use_cache):
+	onnx_model = GPT.OnnxModel(file_path, GPT_CONFIG_124M["context_length"])
+	input_ids = torch.randint(0, GPT_CONFIG_124M["vocab_size"], (2, 16))
+	with torch.no_grad():
+		if use_cache:
+			logits = model(input_ids, kv_cache=model.new_kv_cache(), positions=-1)
+			start_time = time.time()
+			onnx_logits = onnx_model(input_ids, kv_cache=onnx_model.new_kv_cache(), positions=-1)
+		else:
+			logits = model(input_ids, positions=-1)
+			start_time = time.time()
+			onnx_logits = onnx_model(input_ids, positions=-1)
+	print(f"Max logits difference: {(logits - onnx_logits).abs().max().item():.2e} ({time.time() - start_time:.3f}s)")
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="ONNX export of a GPT checkpoint")
+	parser.add_argument("--checkpoint", required=True, help="Checkpoint to export")
+	parser.add_argument("--output", required=True, help="Path of the ONNX graph")
+	parser.add_argument("--out-features", type=int, default=None, help="Output size of a classifier head (e.g. 2)")
+	parser.add_argument("--use-cache", action="store_true", help="Export the kv cache decoder graph (generation)")
+	parser.add_argument("--opset", type=int, default=17)
+	args = parser.parse_args()
+
+	model = GPT.load_model(GPT_CONFIG_124M, args.checkpoint, torch.device("cpu"), out_features=args.out_features)
+	GPT.export_onnx(model, args.output, use_cache=args.use_cache, opset_version=args.opset)
+	print(f"ONNX graph saved as {args.output}")
+	check_export(model, args.output, args.use_cache)
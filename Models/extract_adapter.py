@@ -0,0 +1,83 @@
+"""
+  Converts a full fine-tuned checkpoint (classifier.pth, Assistant.pth) into a low-rank adapter of the
+  base GPT-2 model, so the API can serve every task from a single copy of the base weights.
+  The base checkpoint is the state dict of the model with the OpenAI weights (GPT.load_weights_into_gpt).
+
+    python extract_adapter.py --base gpt2-124M.pth --finetuned classifier.pth --output classifier-adapter.pth --out-features 2
+    python extract_adapter.py --base gpt2-124M.pth --finetuned Assistant.pth --output Assistant-adapter.pth
+
+  The low-rank approximation (and the token embedding, not kept) changes the results, the drift is reported
+  with --test-csv (classifier accuracy) or --test-text (language model loss).
+"""
+import torch
+import argparse
+import GPT
+import GPTC
+from torch.utils.data import DataLoader
+
+
+# Model cunfiguration
+GPT_CONFIG_124M = {
+    "vocab_size": 50257,    # Vocabulary size
+    "context_length": 1024, # context 
+    "emb_dim": 768,         # Embedding dimension
+    "n_heads": 12,          # Number of attention heads
+    "n_layers": 12,         # Number of layers
+    "drop_rate": 0.1,       # Dropout rate
+    "qkv_bias": True,       # Query-key-value bias
+    "fused_qkv": True       # Single query-key-value projection (as served by API.py)
+}
+
+
+
+# Metric of the fine-tuned model and of the base model with the adapter on the test data
+def adapter_drift(finetuned_model, adapted_model, args, device):
+	if args.test_csv is not None:
+		tokenizer = GPT.create_tokenizer()
+		test_dataset = GPTC.SpamDataset(csv_file=args.test_csv, max_length=args.max_length, tokenizer=tokenizer)
+		test_loader = DataLoader(dataset=test_dataset, batch_size=8, num_workers=0, drop_last=False)
+		accuracy = GPTC.calc_accuracy_loader(test_loader, finetuned_model, device)
+		adapter_accuracy = GPTC.calc_accuracy_loader(test_loader, adapted_model, device)
+		print(f"Test accuracy: fine-tuned {accuracy*100:.2f}% | adapter {adapter_accuracy*100:.2f}% | "
+		      f"drift {(adapter_accuracy - accuracy)*100:+.2f}%")
+	if args.test_text is not None:
+		with open(args.test_text, "r", encoding="utf-8") as file:
+			text_data = file.read()
+		test_loader = GPT.create_data_loader(text_data, batch_size=4, max_length=256, stride=256, shuffle=False, drop_last=False)
+		with torch.no_grad():
+			loss = GPT.calc_loss_loader(test_loader, finetuned_model, device)
+			adapter_loss = GPT.calc_loss_loader(test_loader, adapted_model, device)
+		print(f"Test loss: fine-tuned {loss:.4f} | adapter {adapter_loss:.4f} | drift {adapter_loss - loss:+.4f}")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Extract a low-rank adapter from a fine-tuned checkpoint")
+	parser.add_argument("--base", required=True, help="Checkpoint of the base model")
+	parser.add_argument("--finetuned", required=True, help="Checkpoint of the fine-tuned model")
+	parser.add_argument("--output", required=True, help="Path of the adapter")
+	parser.add_argument("--rank", type=int, default=16, help="Rank of the adapter")
+	parser.add_argument("--out-features", type=int, default=None, help="Output classes of a replaced head (e.g. 2)")
+	parser.add_argument("--test-csv", default=None, help="Spam test split, to report the accuracy drift of the adapter")
+	parser.add_argument("--max-length", type=int, default=120, help="Padding length of the classifier inputs")
+	parser.add_argument("--test-text", default=None, help="Text file, to report the loss drift of the adapter")
+	args = parser.parse_args()
+
+	device = torch.device("cpu")
+	base_model = GPT.load_model(GPT_CONFIG_124M, args.base, device)
+	finetuned_model = GPT.load_model(GPT_CONFIG_124M, args.finetuned, device, out_features=args.out_features)
+
+	adapter = GPT.extract_adapter(base_model, finetuned_model, rank=args.rank)
+	torch.save(adapter, args.output)
+
+	num_params = sum(A.numel() + B.numel() for A, B in adapter["lora"].values())
+	num_params += sum(tensor.numel() for tensor in adapter["params"].values())
+	if adapter["out_head"] is not None:
+		num_params += sum(tensor.numel() for tensor in adapter["out_head"].values())
+	print(f"Adapter saved as {args.output}: {num_params:,} parameters "
+	      f"({len(adapter['lora'])} low-rank layers, {len(adapter['params'])} full tensors)")
+
+	# Base model with the adapter, as served by the API
+	adapted_model = GPT.add_lora_layers(base_model)
+	GPT.load_adapter(adapted_model, "adapter", adapter)
+	GPT.set_adapter(adapted_model, "adapter")
+	adapter_drift(finetuned_model, adapted_model, args, device)
@@ -0,0 +1,77 @@
+"""
+  Converts a checkpoint to dynamic int8 quantization of the linear layers and reports the size
+  of both models, and for the classifier the accuracy drift on the spam test split.
+
+    python quantize_model.py --checkpoint classifier.pth --output classifier-int8.pth --out-features 2 --test-csv test.csv
+    python quantize_model.py --checkpoint Assistant.pth --output Assistant-int8.pth
+
+  The model has the configuration served by API.py (fused query-key-value projection), the API loads the
+  converted checkpoints (classifier-int8.pth, Assistant-int8.pth) with GPT_QUANTIZE=1.
+"""
+import io
+import time
+import torch
+import argparse
+import GPT
+import GPTC
+from torch.utils.data import DataLoader
+
+
+# Model cunfiguration (as served by API.py)
+GPT_CONFIG_124M = {
+    "vocab_size": 50257,    # Vocabulary size
+    "context_length": 1024, # context 
+    "emb_dim": 768,         # Embedding dimension
+    "n_heads": 12,          # Number of attention heads
+    "n_layers": 12,         # Number of layers
+    "drop_rate": 0.1,       # Dropout rate
+    "qkv_bias": True,       # Query-key-value bias
+    "attn_backend": "sdpa", # Fused scaled dot product attention
+    "fused_qkv": True,      # Single query-key-value projection
+    "fused_ops": True       # Fused LayerNorm and GELU kernels
+}
+
+
+
+# Size of the serialized state dict in MB
+def state_dict_size(model):
+	buffer = io.BytesIO()
+	torch.save(model.state_dict(), buffer)
+	return buffer.getbuffer().nbytes / 1e6
+
+
+
+# Accuracy and evaluation time on the data loader
+def timed_accuracy(data_loader, model, device):
+	start_time = time.time()
+	accuracy = GPTC.calc_accuracy_loader(data_loader, model, device)
+	return accuracy, time.time() - start_time
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Dynamic int8 quantization of a GPT checkpoint")
+	parser.add_argument("--checkpoint", required=True, help="Checkpoint of the fp32 model")
+	parser.add_argument("--output", required=True, help="Path of the quantized checkpoint")
+	parser.add_argument("--out-features", type=int, default=None, help="Output classes of a classifier (e.g. 2)")
+	parser.add_argument("--test-csv", default=None, help="Spam test split, to report the accuracy drift")
+	parser.add_argument("--max-length", type=int, default=120, help="Padding length of the classifier inputs")
+	args = parser.parse_args()
+
+	device = torch.device("cpu")
+	model = GPT.load_model(GPT_CONFIG_124M, args.checkpoint, device, out_features=args.out_features)
+	quantized_model = GPT.quantize_model(model)
+	torch.save(quantized_model.state_dict(), args.output)
+	print(f"Quantized model saved as {args.output}")
+	print(f"Size: fp32 {state_dict_size(model):.1f} MB | int8 {state_dict_size(quantized_model):.1f} MB")
+
+	if args.test_csv is not None:
+		tokenizer = GPT.create_tokenizer()
+		test_dataset = GPTC.SpamDataset(csv_file=args.test_csv, max_length=args.max_length, tokenizer=tokenizer)
+		test_loader = DataLoader(dataset=test_dataset, batch_size=8, num_workers=0, drop_last=False)
+
+		accuracy, seconds = timed_accuracy(test_loader, model, device)
+		quantized_accuracy, quantized_seconds = timed_accuracy(test_loader, quantized_model, device)
+		print(f"Test accuracy: fp32 {accuracy*100:.2f}% ({seconds:.1f}s) | "
+		      f"int8 {quantized_accuracy*100:.2f}% ({quantized_seconds:.1f}s) | "
+		      f"drift {(quantized_accuracy - accuracy)*100:+.2f}%")
@@ -0,0 +1,60 @@
+"""
+  Offline tokenization into the token cache, so the datasets built with the same cache_dir
+  (GPTDataset / create_data_loader, SpamDataset, InstructionDataset) load the tokens instead of
+  tokenizing again. The files are processed in parallel by a pool of processes.
+
+    python tokenize_corpus.py --kind text --cache-dir token_cache the-verdict.txt shard-*.txt
+    python tokenize_corpus.py --kind spam --cache-dir token_cache train.csv validation.csv test.csv
+    python tokenize_corpus.py --kind instruction --cache-dir token_cache instruction-data.json
+
+  For text files the printed paths are token files, usable with GPT.TokenFileDataset / TokenShardDataset.
+"""
+import json
+import time
+import argparse
+import GPT
+import GPTA
+import GPTC
+from concurrent.futures import ProcessPoolExecutor
+
+
+
+# Tokenizes one file into the cache, returns the path of the cache entry of a text file
+def tokenize_file(kind, file_path, cache_dir, num_threads):
+	tokenizer = GPT.create_tokenizer()
+	if kind == "text":
+		with open(file_path, "r", encoding="utf-8") as file:
+			return GPT.cached_token_file(file.read(), tokenizer, cache_dir, num_threads)
+	if kind == "spam":
+		GPTC.SpamDataset(csv_file=file_path, tokenizer=tokenizer, cache_dir=cache_dir)
+		return None
+	with open(file_path, "r") as file:
+		data = json.load(file)
+	# Same splits as the Assistant notebook, every split is a cache entry of its own
+	train_portion = int(len(data) * 0.85)
+	test_portion = int(len(data) * 0.1)
+	for split in (data[:train_portion], data[train_portion:train_portion + test_portion], data[train_portion + test_portion:]):
+		GPTA.InstructionDataset(split, tokenizer, cache_dir=cache_dir)
+	return None
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Tokenize corpora into the token cache")
+	parser.add_argument("files", nargs="+", help="Files to tokenize")
+	parser.add_argument("--kind", choices=["text", "spam", "instruction"], required=True)
+	parser.add_argument("--cache-dir", default="token_cache", help="Directory of the token cache")
+	parser.add_argument("--workers", type=int, default=4, help="Processes tokenizing files in parallel")
+	parser.add_argument("--threads", type=int, default=8, help="Tokenizer threads of every process")
+	args = parser.parse_args()
+
+	start_time = time.time()
+	with ProcessPoolExecutor(max_workers=args.workers) as executor:
+		futures = {
+			file_path: executor.submit(tokenize_file, args.kind, file_path, args.cache_dir, args.threads)
+			for file_path in args.files
+		}
+		for file_path, future in futures.items():
+			cache_path = future.result()
+			print(f"{file_path} -> {cache_path}" if cache_path is not None else f"{file_path} tokenized")
+	print(f"Tokenization completed in {time.time() - start_time:.1f} seconds.")
@@ -0,0 +1,157 @@
+"""
+  Distributed data-parallel training (gloo backend, runs on CPU-only machines). Every process trains on
+  its own shard of the dataset, the gradients and the evaluation losses are averaged over all the
+  processes and only the first process prints and saves the model. Launch it with torchrun:
+
+    torchrun --nproc_per_node=4 train_ddp.py --task pretrain --data the-verdict.txt --output model.pth
+    torchrun --nproc_per_node=4 train_ddp.py --task classifier --data train.csv --val-data validation.csv --init gpt2-124M.pth --output classifier.pth
+    torchrun --nproc_per_node=4 train_ddp.py --task instruct --data instruction-data.json --init gpt2-124M.pth --output Assistant.pth
+
+  Draft model of the speculative decoding of the API (GPT_DRAFT_MODEL, GPT_DRAFT_LAYERS=4): the first blocks
+  of the assistant, fine-tuned on the instructions without the rest of them:
+
+    torchrun --nproc_per_node=4 train_ddp.py --task instruct --data instruction-data.json --init Assistant.pth --n-layers 4 --output Assistant-draft.pth
+
+  Multiple nodes: add --nnodes, --node_rank and --master_addr/--master_port to torchrun. torchrun sets
+  OMP_NUM_THREADS=1 if it is not set, give each process its share of the cores with it.
+"""
+import json
+import time
+import torch
+import argparse
+import GPT
+import GPTA
+import GPTC
+import torch.distributed as dist
+from functools import partial
+from torch.utils.data import DataLoader
+from torch.utils.data import DistributedSampler
+
+
+# Model cunfiguration
+GPT_CONFIG_124M = {
+    "vocab_size": 50257,    # Vocabulary size
+    "context_length": 1024, # context 
+    "emb_dim": 768,         # Embedding dimension
+    "n_heads": 12,          # Number of attention heads
+    "n_layers": 12,         # Number of layers
+    "drop_rate": 0.1,       # Dropout rate
+    "qkv_bias": True        # Query-key-value bias
+}
+
+
+
+# Train/validation datasets of the task (and the collate function of the batches)
+def create_datasets(args, tokenizer):
+	if args.task == "pretrain":
+		with open(args.data, "r", encoding="utf-8") as file:
+			text_data = file.read()
+		train_data, val_data = GPT.train_test_split(text_data, train_ratio=0.9)
+		train_dataset = GPT.GPTDataset(train_data, tokenizer, args.max_length, args.max_length)
+		val_dataset = GPT.GPTDataset(val_data, tokenizer, args.max_length, args.max_length)
+		return train_dataset, val_dataset, None
+
+	if args.task == "classifier":
+		train_dataset = GPTC.SpamDataset(csv_file=args.data, max_length=None, tokenizer=tokenizer, dynamic_padding=args.dynamic_padding)
+		val_dataset = GPTC.SpamDataset(csv_file=args.val_data, max_length=train_dataset.max_length, tokenizer=tokenizer, dynamic_padding=args.dynamic_padding)
+		return train_dataset, val_dataset, train_dataset.collate if args.dynamic_padding else None
+
+	with open(args.data, "r") as file:
+		data = json.load(file)
+	train_portion = int(len(data) * 0.85)
+	test_portion = int(len(data) * 0.1)
+	train_dataset = GPTA.InstructionDataset(data[:train_portion], tokenizer)
+	val_dataset = GPTA.InstructionDataset(data[train_portion + test_portion:], tokenizer)
+	collate_fn = partial(GPTA.input_preparation_txt, device="cpu", allowed_max_length=GPT_CONFIG_124M["context_length"])
+	return train_dataset, val_dataset, collate_fn
+
+
+
+def create_model(args):
+	model = GPT.GPTModel({**GPT_CONFIG_124M, "n_layers": args.n_layers})
+	if args.init is not None:
+		state_dict = torch.load(args.init, map_location="cpu", weights_only=True)
+		# A model with fewer layers (e.g. a draft model) starts from the first blocks of the checkpoint
+		state_dict = {
+			name: tensor for name, tensor in state_dict.items()
+			if not name.startswith("trf_blocks.") or int(name.split(".")[1]) < args.n_layers
+		}
+		model.load_state_dict(state_dict)
+	if args.task == "classifier":
+		# Only the last block, the final norm and the new head are trained
+		for param in model.parameters():
+			param.requires_grad = False
+		model.out_head = torch.nn.Linear(in_features=GPT_CONFIG_124M["emb_dim"], out_features=2)
+		for param in model.trf_blocks[-1].parameters():
+			param.requires_grad = True
+		for param in model.final_norm.parameters():
+			param.requires_grad = True
+	return model
+
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Distributed data-parallel training")
+	parser.add_argument("--task", choices=["pretrain", "classifier", "instruct"], required=True)
+	parser.add_argument("--data", required=True, help="Training data (text, csv or instruction json)")
+	parser.add_argument("--val-data", default=None, help="Validation csv of the classifier")
+	parser.add_argument("--init", default=None, help="Checkpoint to start from (e.g. the OpenAI weights)")
+	parser.add_argument("--output", required=True, help="Path of the trained checkpoint")
+	parser.add_argument("--epochs", type=int, default=3)
+	parser.add_argument("--batch-size", type=int, default=2, help="Batch size of every process")
+	parser.add_argument("--max-length", type=int, default=256, help="Window length of the pre-training")
+	parser.add_argument("--lr", type=float, default=5e-5)
+	parser.add_argument("--eval-freq", type=int, default=5)
+	parser.add_argument("--eval-iter", type=int, default=5)
+	parser.add_argument("--accumulation-steps", type=int, default=1)
+	parser.add_argument("--n-layers", type=int, default=GPT_CONFIG_124M["n_layers"], help="Transformer blocks (fewer for a draft model)")
+	parser.add_argument("--dynamic-padding", action="store_true", help="Classifier: pad every batch to its longest message and read the last real token")
+	args = parser.parse_args()
+
+	dist.init_process_group(backend="gloo")
+	torch.manual_seed(123)
+	device = torch.device("cpu")
+	tokenizer = GPT.create_tokenizer()
+
+	train_dataset, val_dataset, collate_fn = create_datasets(args, tokenizer)
+	# Every process gets its own shard of the data
+	train_loader = DataLoader(
+		train_dataset,
+		batch_size=args.batch_size,
+		sampler=DistributedSampler(train_dataset, shuffle=True, drop_last=True),
+		collate_fn=collate_fn,
+		drop_last=True,
+		num_workers=0
+	)
+	val_loader = DataLoader(
+		val_dataset,
+		batch_size=args.batch_size,
+		sampler=DistributedSampler(val_dataset, shuffle=False),
+		collate_fn=collate_fn,
+		drop_last=False,
+		num_workers=0
+	)
+
+	# The buffers (causal masks) are constant, no need to broadcast them on every forward
+	model = torch.nn.parallel.DistributedDataParallel(create_model(args), broadcast_buffers=False)
+	optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=args.lr, weight_decay=0.1)
+
+	start_time = time.time()
+	if args.task == "classifier":
+		GPTC.train_classifier_simple(
+			model, train_loader, val_loader, optimizer, device,
+			num_epochs=args.epochs, eval_freq=args.eval_freq, eval_iter=args.eval_iter
+		)
+	else:
+		start_context = "Every effort moves you" if args.task == "pretrain" else GPTA.format_input(val_dataset.data[0])
+		GPT.train_model_simple(
+			model, train_loader, val_loader, optimizer, device,
+			num_epochs=args.epochs, eval_freq=args.eval_freq, eval_iter=args.eval_iter,
+			start_context=start_context, tokenizer=tokenizer, accumulation_steps=args.accumulation_steps
+		)
+
+	if GPT.is_main_process():
+		print(f"Training completed in {(time.time() - start_time) / 60:.2f} minutes.")
+		torch.save(model.module.state_dict(), args.output)
+		print(f"Model saved as {args.output}")
+	dist.destroy_process_group()
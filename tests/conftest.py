@@ -0,0 +1,22 @@
+import os
+import sys
+
+# The modules are imported as top level modules (like API.py does)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "API"))
+
+import pytest
+
+
+# Tiny random GPTModel (vocab 100, context 32) for the generation tests
+@pytest.fixture
+def make_model():
+	def make(n_layers=2, seed=123, **cfg):
+		import torch
+		import GPT
+		torch.manual_seed(seed)
+		config = {
+			"vocab_size": 100, "context_length": 32, "emb_dim": 32, "n_heads": 4,
+			"n_layers": n_layers, "drop_rate": 0.0, "qkv_bias": True, **cfg
+		}
+		return GPT.GPTModel(config).eval()
+	return make
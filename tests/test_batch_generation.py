@@ -0,0 +1,38 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("tiktoken")
+
+import GPT
+
+
+def random_prompts(lengths, seed=0):
+	generator = torch.Generator().manual_seed(seed)
+	return [torch.randint(0, 100, (length,), generator=generator).tolist() for length in lengths]
+
+
+def single_generation(model, prompt, num_token_generation, eos_id=None):
+	idx = torch.tensor([prompt])
+	token_ids = GPT.text_generation(model, idx, num_token_generation, context_size=32, eos_id=eos_id, use_cache=True)
+	return token_ids[0, len(prompt):].tolist()
+
+
+@pytest.mark.parametrize("attn_backend", ["manual", "sdpa"])
+def test_batch_matches_single_generation(make_model, attn_backend):
+	model = make_model(attn_backend=attn_backend)
+	# The longer prompts reach the context length (32), so the window slides
+	prompts = random_prompts([3, 10, 30, 40])
+
+	generated = GPT.batch_text_generation(model, prompts, 12, context_size=32, device="cpu")
+	assert generated == [single_generation(model, prompt, 12) for prompt in prompts]
+
+
+def test_batch_stops_every_row_on_its_eos(make_model):
+	model = make_model()
+	prompts = random_prompts([4, 9, 15], seed=1)
+	# A token the second prompt generates, the rows stop at different steps (or not at all)
+	eos_id = single_generation(model, prompts[1], 12)[2]
+
+	generated = GPT.batch_text_generation(model, prompts, 12, context_size=32, device="cpu", eos_id=eos_id)
+	assert generated == [single_generation(model, prompt, 12, eos_id=eos_id) for prompt in prompts]
+	assert len(generated[1]) <= 2
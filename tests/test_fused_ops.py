@@ -0,0 +1,77 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+import GPT
+
+
+@pytest.fixture(autouse=True)
+def seed():
+	torch.manual_seed(123)
+
+
+@pytest.mark.parametrize("shape", [(2, 5, 768), (1, 1, 768), (3, 64)])
+def test_layer_norm_parity(shape):
+	reference = GPT.LayerNorm(shape[-1])
+	fused = GPT.LayerNorm(shape[-1], fused=True)
+	with torch.no_grad():
+		reference.scale.copy_(torch.randn(shape[-1]))
+		reference.shift.copy_(torch.randn(shape[-1]))
+	fused.load_state_dict(reference.state_dict())
+
+	x = torch.randn(shape) * 3 + 1
+	torch.testing.assert_close(fused(x), reference(x))
+
+
+def test_layer_norm_parity_bf16():
+	reference = GPT.LayerNorm(768)
+	fused = GPT.LayerNorm(768, fused=True)
+	x = torch.randn(2, 5, 768).to(torch.bfloat16)
+	assert fused(x).dtype == torch.bfloat16
+	torch.testing.assert_close(fused(x), reference(x))
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_gelu_parity(dtype):
+	x = (torch.randn(4, 16, 3072) * 4).to(dtype)
+	fused = GPT.GELU(fused=True)(x)
+	assert fused.dtype == dtype
+	torch.testing.assert_close(fused, GPT.GELU()(x))
+
+
+def test_reference_state_dict_loads_into_fused_model():
+	cfg = {
+		"vocab_size": 100, "context_length": 16, "emb_dim": 32, "n_heads": 4,
+		"n_layers": 2, "drop_rate": 0.0, "qkv_bias": True
+	}
+	reference = GPT.GPTModel(cfg).eval()
+	fused = GPT.GPTModel({**cfg, "fused_ops": True}).eval()
+	fused.load_state_dict(reference.state_dict())
+	assert set(fused.state_dict()) == set(reference.state_dict())
+
+	in_idx = torch.randint(0, cfg["vocab_size"], (2, 10))
+	with torch.no_grad():
+		torch.testing.assert_close(fused(in_idx), reference(in_idx))
+
+
+def test_split_checkpoint_is_converted_once_for_the_fused_model(tmp_path):
+	cfg = {
+		"vocab_size": 100, "context_length": 16, "emb_dim": 32, "n_heads": 4,
+		"n_layers": 2, "drop_rate": 0.0, "qkv_bias": True
+	}
+	reference = GPT.GPTModel(cfg).eval()
+	checkpoint_path = str(tmp_path / "model.pth")
+	torch.save(reference.state_dict(), checkpoint_path)
+
+	fused = GPT.load_model({**cfg, "fused_qkv": True}, checkpoint_path, torch.device("cpu"))
+	fused_path = tmp_path / "model-fused.pth"
+	assert fused_path.exists()
+	assert not any("W_query" in key for key in torch.load(fused_path, weights_only=True))
+	in_idx = torch.randint(0, cfg["vocab_size"], (2, 10))
+	with torch.no_grad():
+		torch.testing.assert_close(fused(in_idx), reference(in_idx))
+
+	# The fused copy is reused while the checkpoint does not change
+	modified_time = fused_path.stat().st_mtime_ns
+	GPT.load_model({**cfg, "fused_qkv": True}, checkpoint_path, torch.device("cpu"))
+	assert fused_path.stat().st_mtime_ns == modified_time
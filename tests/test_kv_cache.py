@@ -0,0 +1,33 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("tiktoken")
+
+import GPT
+
+
+@pytest.mark.parametrize("attn_backend", ["manual", "sdpa"])
+@pytest.mark.parametrize("prompt_length", [1, 5, 32])
+def test_cached_generation_matches_uncached(make_model, attn_backend, prompt_length):
+	model = make_model(attn_backend=attn_backend)
+	idx = torch.randint(0, 100, (1, prompt_length), generator=torch.Generator().manual_seed(prompt_length))
+
+	# 40 new tokens go past the context length (32), so the cached window is refilled
+	uncached = list(GPT.stream_text_generation(model, idx, 40, context_size=32))
+	cached = list(GPT.stream_text_generation(model, idx, 40, context_size=32, use_cache=True))
+	assert torch.equal(torch.cat(cached, dim=1), torch.cat(uncached, dim=1))
+
+
+@pytest.mark.parametrize("attn_backend", ["manual", "sdpa"])
+def test_cached_logits_match_full_forward(make_model, attn_backend):
+	model = make_model(attn_backend=attn_backend)
+	idx = torch.randint(0, 100, (2, 12), generator=torch.Generator().manual_seed(0))
+
+	with torch.no_grad():
+		expected = model(idx)
+		kv_cache = model.new_kv_cache()
+		logits = [model(idx[:, :8], kv_cache=kv_cache)]
+		for i in range(8, 12):
+			logits.append(model(idx[:, i:i + 1], kv_cache=kv_cache))
+	assert len(kv_cache) == 12
+	torch.testing.assert_close(torch.cat(logits, dim=1), expected, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,55 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("tiktoken")
+
+import GPT
+
+
+def random_tokens(length, seed, low=0, high=100):
+	return torch.randint(low, high, (length,), generator=torch.Generator().manual_seed(seed)).tolist()
+
+
+def stream_generation(model, prompt, prefix_cache=None):
+	idx = torch.tensor([prompt])
+	return torch.cat(list(GPT.stream_text_generation(model, idx, 8, context_size=32, use_cache=True, prefix_cache=prefix_cache)), dim=1)
+
+
+@pytest.mark.parametrize("attn_backend", ["manual", "sdpa"])
+def test_stream_prefix_cache_hit_matches_miss(make_model, attn_backend):
+	model = make_model(attn_backend=attn_backend)
+	prefix_cache = GPT.PrefixCache()
+	preamble = random_tokens(12, seed=0)
+	stored_prompt = preamble + random_tokens(6, seed=1, high=50)
+	new_prompt = preamble + random_tokens(4, seed=2, low=50)
+
+	expected = stream_generation(model, stored_prompt)
+	assert torch.equal(stream_generation(model, stored_prompt, prefix_cache), expected)
+	# Same prompt again: everything but its last token comes from the cache
+	assert len(prefix_cache.lookup(stored_prompt, max_tokens=len(stored_prompt) - 1)) == len(stored_prompt) - 1
+	assert torch.equal(stream_generation(model, stored_prompt, prefix_cache), expected)
+
+	# Shared prefix shorter than the stored prompt
+	assert len(prefix_cache.lookup(new_prompt)) == len(preamble)
+	assert torch.equal(stream_generation(model, new_prompt, prefix_cache), stream_generation(model, new_prompt))
+
+
+@pytest.mark.parametrize("attn_backend", ["manual", "sdpa"])
+def test_batch_prefix_cache_hit_matches_miss(make_model, attn_backend):
+	model = make_model(attn_backend=attn_backend)
+	prefix_cache = GPT.PrefixCache()
+	preamble = random_tokens(10, seed=0)
+	first_batch = [preamble + random_tokens(length, seed=length, high=50) for length in (3, 7, 5)]
+	second_batch = [preamble + random_tokens(length, seed=10 + length, low=50) for length in (2, 6)]
+
+	def generate(prompts, prefix_cache=None):
+		return GPT.batch_text_generation(model, prompts, 8, context_size=32, device="cpu", prefix_cache=prefix_cache)
+
+	expected = generate(first_batch)
+	assert generate(first_batch, prefix_cache) == expected
+	# Hit on the longest prompt of the first batch (shared by the whole batch up to the preamble)
+	assert generate(first_batch, prefix_cache) == expected
+
+	# Shared prefix (the preamble) shorter than the stored prompt
+	assert len(prefix_cache.lookup(second_batch[0])) == len(preamble)
+	assert generate(second_batch, prefix_cache) == generate(second_batch)
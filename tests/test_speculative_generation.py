@@ -0,0 +1,41 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("tiktoken")
+
+import GPT
+
+
+@pytest.mark.parametrize("attn_backend", ["manual", "sdpa"])
+@pytest.mark.parametrize("num_draft_tokens", [1, 2, 4, 6])
+@pytest.mark.parametrize("prompt_length", [5, 20, 30])
+def test_speculative_matches_greedy(make_model, attn_backend, num_draft_tokens, prompt_length):
+	model = make_model(n_layers=2, attn_backend=attn_backend)
+	draft_model = make_model(n_layers=1, seed=7, attn_backend=attn_backend)
+	# Long prompts reach the end of the context (32) and continue with the sliding window
+	idx = torch.randint(0, 100, (1, prompt_length), generator=torch.Generator().manual_seed(prompt_length))
+
+	expected = GPT.text_generation(model, idx, 16, context_size=32, temperature=0.0, use_cache=True)
+	generated = GPT.speculative_text_generation(model, draft_model, idx, 16, context_size=32, num_draft_tokens=num_draft_tokens)
+	assert torch.equal(generated, expected)
+
+
+def test_speculative_with_itself_as_draft_accepts_everything(make_model):
+	model = make_model(n_layers=2)
+	idx = torch.randint(0, 100, (1, 4), generator=torch.Generator().manual_seed(0))
+
+	expected = GPT.text_generation(model, idx, 12, context_size=32, temperature=0.0, use_cache=True)
+	generated = GPT.speculative_text_generation(model, model, idx, 12, context_size=32, num_draft_tokens=3)
+	assert torch.equal(generated, expected)
+
+
+def test_speculative_stops_on_eos(make_model):
+	model = make_model(n_layers=2)
+	draft_model = make_model(n_layers=1, seed=7)
+	idx = torch.randint(0, 100, (1, 5), generator=torch.Generator().manual_seed(1))
+
+	greedy = GPT.text_generation(model, idx, 12, context_size=32, temperature=0.0, use_cache=True)
+	eos_id = greedy[0, 5 + 3].item()
+	expected = GPT.text_generation(model, idx, 12, context_size=32, temperature=0.0, eos_id=eos_id, use_cache=True)
+	generated = GPT.speculative_text_generation(model, draft_model, idx, 12, context_size=32, num_draft_tokens=4, eos_id=eos_id)
+	assert torch.equal(generated, expected)
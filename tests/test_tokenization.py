@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("tiktoken")
+
+import GPT
+
+
+TEXT = (
+	"I HAD always thought Jack Gisburn rather a cheap genius--though a good fellow enough--so it was no\n\n"
+	"great surprise to me to hear that, in the height of his glory, he had dropped his painting. \n"
+	"It's a line ending with a space.\nA single new line,\n\n\n  indented text\t\n"
+	"<|endoftext|>The next document\n<|endoftext|>\n"
+) * 20
+
+
+@pytest.mark.parametrize("num_threads", [1, 4, 16])
+def test_encode_text_matches_encode(num_threads):
+	tokenizer = GPT.create_tokenizer()
+	expected = tokenizer.encode(TEXT, allowed_special={"<|endoftext|>"})
+	assert GPT.encode_text(TEXT, tokenizer, num_threads=num_threads).tolist() == expected
+
+
+def test_cached_encode_text_matches_encode(tmp_path):
+	tokenizer = GPT.create_tokenizer()
+	expected = tokenizer.encode(TEXT, allowed_special={"<|endoftext|>"})
+	assert GPT.encode_text(TEXT, tokenizer, cache_dir=tmp_path).tolist() == expected
+	# Second call reads the cache
+	assert GPT.encode_text(TEXT, tokenizer, cache_dir=tmp_path).tolist() == expected
+
+
+def test_split_text_keeps_whitespace_runs():
+	chunks = GPT.split_text(TEXT, 64)
+	assert "".join(chunks) == TEXT
+	for chunk in chunks[:-1]:
+		assert chunk.endswith("\n") and not chunk[-2].isspace()